@@ -0,0 +1,225 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+# rendered pdfs are kept under <root>/<order id>/<first 16 hex digits of their sha256>/<name>
+ARTIFACTS_DIR = os.environ.get("ARTIFACTS_DIR", "./temp/artifacts")
+# keep the artifacts in memory backed /dev/shm instead, they are only a cache of what is in s3
+ARTIFACTS_TMPFS = os.environ.get("ARTIFACTS_TMPFS", "0") == "1"
+TMPFS_DIR = "/dev/shm/zippz_artifacts"
+# least recently used artifacts are evicted once the store holds more than this
+ARTIFACTS_MAX_BYTES = int(os.environ.get("ARTIFACTS_MAX_BYTES", str(2 * 1024 ** 3)))
+# artifacts not used for this many seconds are evicted whatever the size of the store
+ARTIFACTS_MAX_AGE = float(os.environ.get("ARTIFACTS_MAX_AGE", str(7 * 24 * 3600)))
+
+HASH_LENGTH = 16
+
+
+def _safe_name(value):
+    name = "".join(c if c.isalnum() or c in "-_." else "_" for c in str(value)).lstrip(".")
+    return name or "unknown"
+
+
+def default_root():
+    if ARTIFACTS_TMPFS and os.path.isdir(os.path.dirname(TMPFS_DIR)):
+        return TMPFS_DIR
+    return ARTIFACTS_DIR
+
+
+# files written once and read many times, bounded by total size and by age. the last use of an
+# artifact is its mtime, so the eviction order survives a restart. the index and the bounds are
+# per process: a process evicts among the artifacts it stored or read, and finds the ones other
+# processes stored on disk when it's asked for them. n processes sharing a root can hold up to
+# n * max_bytes
+class ArtifactStore:
+
+    def __init__(self, root=None, max_bytes=ARTIFACTS_MAX_BYTES, max_age=ARTIFACTS_MAX_AGE):
+        self.root = root or default_root()
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # relative path => (size, last use), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._scanned = False
+
+    def _relative_path(self, order_id, name, sha256):
+        return os.path.join(_safe_name(order_id), sha256[:HASH_LENGTH], _safe_name(name))
+
+    # indexes what an earlier process left in the store, the first time the store is used
+    def _scan(self):
+        if self._scanned:
+            return
+        self._scanned = True
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        for directory, _, files in os.walk(self.root):
+            for file_name in files:
+                path = os.path.join(directory, file_name)
+                if file_name.endswith(".tmp"):
+                    # left by a process that died while writing
+                    _remove(path)
+                    continue
+                relative_path = os.path.relpath(path, self.root)
+                if relative_path.count(os.sep) != 2:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, relative_path, stat.st_size))
+        for mtime, relative_path, size in sorted(found):
+            self._add(relative_path, size, mtime)
+        self._evict()
+
+    def _add(self, relative_path, size, used_at):
+        previous = self._entries.pop(relative_path, None)
+        if previous is not None:
+            self._bytes -= previous[0]
+        self._entries[relative_path] = (size, used_at)
+        self._bytes += size
+
+    def _drop(self, relative_path):
+        size, _ = self._entries.pop(relative_path)
+        self._bytes -= size
+
+    # indexes the artifact from disk, the one with that hash or the one used last. returns its
+    # relative path or None
+    def _find(self, order_id, name, sha256):
+        order_dir = _safe_name(order_id)
+        if sha256 is None:
+            try:
+                hashes = os.listdir(os.path.join(self.root, order_dir))
+            except FileNotFoundError:
+                return None
+        else:
+            hashes = [sha256[:HASH_LENGTH]]
+        found = None
+        for sha256_prefix in hashes:
+            relative_path = os.path.join(order_dir, sha256_prefix, _safe_name(name))
+            try:
+                stat = os.stat(os.path.join(self.root, relative_path))
+            except OSError:
+                continue
+            if found is None or stat.st_mtime > found[0]:
+                found = (stat.st_mtime, relative_path, stat.st_size)
+        if found is None:
+            return None
+        mtime, relative_path, size = found
+        self._add(relative_path, size, mtime)
+        return relative_path
+
+    def _evict(self, keep=None):
+        expired = time.time() - self.max_age
+        while self._entries:
+            relative_path, (size, used_at) = next(iter(self._entries.items()))
+            if relative_path == keep or (used_at >= expired and self._bytes <= self.max_bytes):
+                break
+            self._drop(relative_path)
+            path = os.path.join(self.root, relative_path)
+            _remove(path)
+            _remove_empty_dirs(os.path.dirname(path), self.root)
+            logging.info("Evicted artifact {} ({} bytes)".format(relative_path, size))
+
+    def _touch(self, relative_path):
+        now = time.time()
+        try:
+            os.utime(os.path.join(self.root, relative_path), (now, now))
+        except FileNotFoundError:
+            # evicted by another process
+            self._drop(relative_path)
+            return False
+        size, _ = self._entries[relative_path]
+        self._add(relative_path, size, now)
+        return True
+
+    # stores the bytes of an artifact of the order and returns its path. the file is written next
+    # to its final name and renamed into place, so readers never see a partial artifact
+    def put(self, order_id, name, data):
+        sha256 = hashlib.sha256(data).hexdigest()
+        relative_path = self._relative_path(order_id, name, sha256)
+        path = os.path.join(self.root, relative_path)
+        with self._lock:
+            self._scan()
+            if relative_path in self._entries and self._touch(relative_path):
+                return path
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self._add(relative_path, len(data), time.time())
+            self._evict(keep=relative_path)
+        return path
+
+    # path of the artifact of the order with that content hash (a prefix of it is enough), or of
+    # the one used last without a hash, None when it isn't in the store. the disk is looked at for
+    # artifacts another process stored
+    def get(self, order_id, name, sha256=None):
+        with self._lock:
+            self._scan()
+            relative_path = None
+            if sha256 is not None:
+                relative_path = self._relative_path(order_id, name, sha256)
+                if relative_path not in self._entries:
+                    relative_path = None
+            if relative_path is None:
+                relative_path = self._find(order_id, name, sha256)
+            if relative_path is None or not self._touch(relative_path):
+                return None
+            self._evict(keep=relative_path)
+        return os.path.join(self.root, relative_path)
+
+    # the artifact opened for reading, or None. the open file can still be read once another
+    # thread or process evicted the artifact, its path can't
+    def open(self, order_id, name, sha256=None):
+        path = self.get(order_id, name, sha256)
+        if path is None:
+            return None
+        try:
+            return open(path, "rb")
+        except FileNotFoundError:
+            return None
+
+    def read(self, order_id, name, sha256=None):
+        f = self.open(order_id, name, sha256)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    # content hash of a stored artifact, from its path
+    @staticmethod
+    def sha256_prefix(path):
+        return os.path.basename(os.path.dirname(path))
+
+    @property
+    def size(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_empty_dirs(directory, root):
+    root = os.path.abspath(root)
+    directory = os.path.abspath(directory)
+    while directory != root and directory.startswith(root):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
+
+
+artifacts = ArtifactStore()
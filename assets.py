@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import math
+import fnmatch
+import hashlib
+import logging
+import argparse
+from urllib.parse import urlparse, unquote
+from PIL import Image
+
+IMAGES_DIR = "./images"
+# processed images are written here under a hash of their source and processing settings
+ASSETS_DIR = os.environ.get("ASSETS_DIR", "./build/assets")
+MANIFEST_NAME = "manifest.json"
+# build the processed images when the render pool starts, deploys that build them ahead can turn it off
+BUILD_ON_START = os.environ.get("ASSETS_BUILD_ON_START", "1") == "1"
+# the cards are printed at this resolution, more pixels than this just make the pdf bigger
+PRINT_DPI = int(os.environ.get("ASSET_PRINT_DPI", "300"))
+# weasyprint lays pages out in css pixels, 96 to the inch
+CSS_DPI = 96
+# bump when the processing changes so every asset gets rebuilt
+PROCESSING_VERSION = 1
+
+# widest box, in css px, each image is drawn in by css/cards.css. images that aren't listed are
+# only capped at the 576px x 384px card
+BOX_WIDTHS = [
+    ("bottles/*", 150),        # .item img
+    ("donuts/*", 84.32),       # #p3 .charts .chart-item img
+    ("faq.png", 115.2),        # #p4 .faq-image img
+    ("signature.png", 144),    # #p2 #ceo_sign
+    ("attention.png", 24),     # .product-container .image img
+    ("moon.png", 23),          # .image_moon img
+    ("leaf.png", 17),          # .image_leaf img
+]
+PAGE_WIDTH = 576
+PAGE_HEIGHT = 384
+
+# qr codes are scanned, they are never resampled
+UNTOUCHED = ["qr*.png"]
+
+_assets = None
+_prepared = False
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _target_size(name, size):
+    width, height = size
+    if any(fnmatch.fnmatch(name, pattern) for pattern in UNTOUCHED):
+        return size
+    box_width = next((box for pattern, box in BOX_WIDTHS if fnmatch.fnmatch(name, pattern)), None)
+    if box_width is not None:
+        scale = math.ceil(box_width / CSS_DPI * PRINT_DPI) / width
+    else:
+        scale = min(PAGE_WIDTH / CSS_DPI * PRINT_DPI / width, PAGE_HEIGHT / CSS_DPI * PRINT_DPI / height)
+    if scale >= 1:
+        return size
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+# downsamples an image to the pixels its box needs at the print resolution, drops an alpha
+# channel that is fully opaque and recompresses it
+def process_image(name, path, output_path):
+    with Image.open(path) as image:
+        image.load()
+        size = _target_size(name, image.size)
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+        if image.mode == "RGBA" and image.getextrema()[3][0] == 255:
+            image = image.convert("RGB")
+        tmp_path = "{}.{}.tmp".format(output_path, os.getpid())
+        image.save(tmp_path, "PNG", optimize=True, dpi=(PRINT_DPI, PRINT_DPI))
+    os.replace(tmp_path, output_path)
+    return size
+
+
+def _read_manifest(assets_dir):
+    try:
+        with open(os.path.join(assets_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_manifest(assets_dir, manifest):
+    path = os.path.join(assets_dir, MANIFEST_NAME)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+# processes every png under images/ that changed since the last build, returns the manifest
+# mapping each image path relative to images/ to its processed file
+def build_assets(images_dir=IMAGES_DIR, assets_dir=ASSETS_DIR):
+    os.makedirs(assets_dir, exist_ok=True)
+    previous = _read_manifest(assets_dir)
+    manifest = {}
+    for root, _, files in os.walk(images_dir):
+        for file_name in sorted(files):
+            if not file_name.lower().endswith(".png"):
+                continue
+            path = os.path.join(root, file_name)
+            name = os.path.relpath(path, images_dir).replace(os.sep, "/")
+            stat = os.stat(path)
+            entry = previous.get(name)
+            if (entry is not None and entry["mtime"] == stat.st_mtime and entry["source_size"] == stat.st_size
+                    and os.path.exists(os.path.join(assets_dir, entry["file"]))):
+                manifest[name] = entry
+                continue
+
+            source_sha256 = _sha256(path)
+            key = hashlib.sha256("{}:{}:{}:{}".format(
+                source_sha256, name, PRINT_DPI, PROCESSING_VERSION).encode("utf-8")).hexdigest()[:20]
+            output_name = "{}.png".format(key)
+            output_path = os.path.join(assets_dir, output_name)
+            if os.path.exists(output_path):
+                with Image.open(output_path) as image:
+                    size = image.size
+            else:
+                size = process_image(name, path, output_path)
+                logging.info("Processed {} {} -> {} {} bytes".format(
+                    name, stat.st_size, size, os.path.getsize(output_path)))
+            manifest[name] = {"file": output_name, "mtime": stat.st_mtime, "source_size": stat.st_size,
+                              "source_sha256": source_sha256, "size": list(size)}
+
+    _write_manifest(assets_dir, manifest)
+    return manifest
+
+
+# reads the processed images into memory keyed by the absolute path of their source, images that
+# were never built or whose source changed since are left to be read from images/
+def load_assets(images_dir=IMAGES_DIR, assets_dir=ASSETS_DIR):
+    assets = {}
+    for name, entry in _read_manifest(assets_dir).items():
+        source = os.path.abspath(os.path.join(images_dir, name))
+        try:
+            stat = os.stat(source)
+            if entry["mtime"] != stat.st_mtime or entry["source_size"] != stat.st_size:
+                logging.warning("Processed image {} is out of date, using the original".format(name))
+                continue
+            with open(os.path.join(assets_dir, entry["file"]), "rb") as f:
+                assets[source] = f.read()
+        except OSError as e:
+            logging.error("Error loading processed image {} {}".format(name, e))
+    logging.info("Loaded {} processed images".format(len(assets)))
+    return assets
+
+
+# builds the processed images once per process, before the render processes that load them start
+def prepare_assets():
+    global _prepared
+    if _prepared or not BUILD_ON_START:
+        return
+    _prepared = True
+    try:
+        build_assets()
+    except OSError as e:
+        logging.error("Error building processed images, rendering with the originals {}".format(e))
+
+
+def get_assets():
+    global _assets
+    if _assets is None:
+        _assets = load_assets()
+    return _assets
+
+
+# serves the images weasyprint asks for from the processed assets, anything else the usual way
+def url_fetcher(url):
+    # imported here so building the assets doesn't need weasyprint and pango
+    from weasyprint import default_url_fetcher
+    if url.startswith("file:"):
+        data = get_assets().get(os.path.abspath(unquote(urlparse(url).path)))
+        if data is not None:
+            return {"string": data, "mime_type": "image/png", "redirected_url": url}
+    return default_url_fetcher(url)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Downsample and optimize the images used by the cards")
+    parser.add_argument("--images", default=IMAGES_DIR)
+    parser.add_argument("--output", default=ASSETS_DIR)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    manifest = build_assets(args.images, args.output)
+    source_bytes = sum(entry["source_size"] for entry in manifest.values())
+    processed_bytes = sum(os.path.getsize(os.path.join(args.output, entry["file"])) for entry in manifest.values())
+    print("{} images, {} bytes -> {} bytes".format(len(manifest), source_bytes, processed_bytes))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import argparse
+import datetime
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from openpyxl import load_workbook
+from application import (SHIPMENTS_FILE, name_mapping, get_catalog, generate_pdfs_for_shippment,
+                         upload_shippment_pdfs, write_signed_urls_to_shippments_file)
+from s3client import generate_presigned_urls
+
+CHECKPOINT_PATH = "./prod/batch_checkpoint.jsonl"
+UPLOAD_WORKERS = 8
+
+# columns of the Orders sheet
+FIRST = 0
+LAST = 1
+EMAIL = 2
+STREET1 = 4
+STREET2 = 5
+CITY = 6
+STATE = 7
+ZIP = 8
+UID = 9
+SLEEP1 = 11
+SLEEP2 = 12
+CALM1 = 13
+CALM2 = 14
+ORDER_NUMBER = 15
+ORDER_DATE = 16
+COLUMNS = 19
+
+
+def _text(value):
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+# Sleep12 => sleep12, anything that isn't one of our products ("-", "n/a", blank) => None
+def _product_id(value):
+    product = _text(value).replace(" ", "").lower()
+    return product if product in name_mapping else None
+
+
+def _order_date(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.strptime(_text(value)[:19], '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+
+
+# builds the same customer dict parse_shippments_items() builds from a webhook, or None when
+# the row doesn't describe a renderable order
+def row_to_shippment(row):
+    row = list(row) + [None] * (COLUMNS - len(row))
+    uuid = _text(row[UID])
+    created = _order_date(row[ORDER_DATE])
+    if not uuid or uuid == "n/a" or created is None:
+        return None
+
+    shippment = {
+        'first': _text(row[FIRST]),
+        'last': _text(row[LAST]),
+        'email': _text(row[EMAIL]),
+        'street1': _text(row[STREET1]),
+        'street2': _text(row[STREET2]),
+        'city': _text(row[CITY]),
+        'state': _text(row[STATE]),
+        'zip': _text(row[ZIP]),
+        'sleep1': _product_id(row[SLEEP1]),
+        'sleep2': _product_id(row[SLEEP2]),
+        'calm1': _product_id(row[CALM1]),
+        'calm2': _product_id(row[CALM2]),
+        'uuid': uuid,
+        'order_number': _text(row[ORDER_NUMBER]),
+        'date_order': created.strftime("%m/%d/%Y"),
+        'date_title': created.strftime('%B %d, %Y'),
+    }
+    has_calms = shippment['calm1'] is not None and shippment['calm2'] is not None
+    has_sleeps = shippment['sleep1'] is not None and shippment['sleep2'] is not None
+    if not has_calms and not has_sleeps:
+        return None
+    return shippment
+
+
+# streams the orders of the shipments file without loading the whole workbook
+def read_shippments(path, min_row=2, max_row=None):
+    wb = load_workbook(filename=path, read_only=True)
+    try:
+        for row in wb['Orders'].iter_rows(min_row=min_row, max_row=max_row, values_only=True):
+            shippment = row_to_shippment(row)
+            if shippment is not None:
+                yield shippment
+    finally:
+        wb.close()
+
+
+# orders that are already rendered and uploaded, one json line per order
+class Checkpoint:
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line of an interrupted run may be cut short
+                        continue
+                    self.done[entry['uuid']] = entry['signed_urls']
+
+    def add(self, uuid, signed_urls):
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"uuid": uuid, "signed_urls": signed_urls}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.done[uuid] = signed_urls
+
+
+def process_shippment(shippment, catalog):
+    uuid = shippment['uuid']
+    inserts_pdf, cards_pdf = generate_pdfs_for_shippment(shippment, catalog.ingredients, catalog.ingredients_legend)
+    if not upload_shippment_pdfs(uuid, inserts_pdf, cards_pdf):
+        # raised so the order isn't checkpointed and the next run retries it
+        raise IOError("Uploading the pdfs of order {} failed".format(uuid))
+    inserts_signed_url, cards_signed_url = generate_presigned_urls(uuid)
+    if cards_signed_url is None:
+        raise IOError("Signing the urls of order {} failed".format(uuid))
+    return {"inserts_signed_url": inserts_signed_url, "cards_signed_url": cards_signed_url}
+
+
+def render_shippments(args):
+    checkpoint = Checkpoint(args.checkpoint)
+    catalog = get_catalog()
+    failed = []
+
+    def collect(futures):
+        for future in futures:
+            uuid = in_flight.pop(future)
+            try:
+                checkpoint.add(uuid, future.result())
+                logging.info("Finished order {} ({} done)".format(uuid, len(checkpoint.done)))
+            except Exception as e:
+                logging.error("Error processing order {} {}".format(uuid, e))
+                failed.append(uuid)
+
+    # rendering fans out to the render pool, these threads keep it busy and do the uploads
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for shippment in read_shippments(args.shipments, args.min_row, args.max_row):
+            if shippment['uuid'] in checkpoint.done:
+                continue
+            future = executor.submit(process_shippment, shippment, catalog)
+            in_flight[future] = shippment['uuid']
+            if len(in_flight) >= args.workers * 2:
+                finished, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                collect(finished)
+        finished, _ = wait(list(in_flight))
+        collect(finished)
+
+    logging.info("Start writing urls to file")
+    write_signed_urls_to_shippments_file(checkpoint.done, min_row=args.min_row, max_row=args.max_row)
+    logging.info("Finished writing {} urls, {} orders failed {}".format(len(checkpoint.done), len(failed), failed))
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render and upload the cards of every order in the shipments file")
+    parser.add_argument("--shipments", default=SHIPMENTS_FILE)
+    parser.add_argument("--min-row", type=int, default=2)
+    parser.add_argument("--max-row", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=UPLOAD_WORKERS,
+                        help="orders processed at the same time")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH,
+                        help="progress file, an interrupted run resumes from it")
+    parser.add_argument("--restart", action="store_true",
+                        help="ignore the progress of a previous run")
+    args = parser.parse_args()
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    return render_shippments(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
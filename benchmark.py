@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import platform
+import itertools
+import statistics
+
+CALM_IDS = ["30", "32", "34", "36", "38", "40"]
+SLEEP_IDS = ["10", "12", "14", "16", "18", "20"]
+
+STAGES = [
+    "parse_shippments_items",
+    "parse_ingredients",
+    "parse_ingredients_legend",
+    "build_template_data",
+    "render_html",
+    "gen_pdf",
+    "gen_cards_pdf",
+    "s3_upload",
+]
+
+# a stage only counts as a regression when its median is this much slower than the baseline
+REGRESSION_THRESHOLD = 0.15
+# and at least this many seconds slower, so sub-millisecond stages don't flag on noise
+REGRESSION_MIN_SECONDS = 0.002
+
+
+def _line_item(id, name, sku=None):
+    return {"id": id, "name": name, "sku": sku, "quantity": 1, "subtotal": "0.00", "product_id": id}
+
+
+# a woocommerce order webhook payload like the ones /api/post/order receives
+def make_payload(order_id, calms=None, sleeps=None, first="Jane", last="Doe",
+                 street1="123 Main St", street2="Apt 4", city="San Francisco"):
+    line_items = [_line_item(1, "Trial 4-Pack #{}".format(order_id), "TRIAL-4")]
+    for calm in calms or []:
+        line_items.append(_line_item(len(line_items) + 1, "CalmZ-{}".format(calm)))
+    for sleep in sleeps or []:
+        line_items.append(_line_item(len(line_items) + 1, "SleepZ-{}".format(sleep)))
+
+    return {
+        "id": order_id,
+        "customer_id": 1000 + order_id,
+        "order_key": "wc_order_{}".format(order_id),
+        "date_created": "2021-07-12T12:39:42",
+        "date_modified": "2021-07-12T12:40:02",
+        "billing": {
+            "first_name": first,
+            "last_name": last,
+            "address_1": street1,
+            "address_2": street2,
+            "city": city,
+            "state": "CA",
+            "postcode": "94107",
+            "country": "US",
+        },
+        "line_items": line_items,
+    }
+
+
+# single issue orders for every calm pair and every sleep pair, two issue orders pairing them up
+# and a few orders with long names and addresses
+def make_payloads():
+    calm_pairs = list(itertools.combinations(CALM_IDS, 2))
+    sleep_pairs = list(itertools.combinations(SLEEP_IDS, 2))
+    payloads = []
+    for calms in calm_pairs:
+        payloads.append(make_payload(len(payloads) + 1, calms=calms))
+    for sleeps in sleep_pairs:
+        payloads.append(make_payload(len(payloads) + 1, sleeps=sleeps))
+    for calms, sleeps in zip(calm_pairs, sleep_pairs):
+        payloads.append(make_payload(len(payloads) + 1, calms=calms, sleeps=sleeps))
+    for calms, sleeps in zip(calm_pairs[:3], reversed(sleep_pairs)):
+        payloads.append(make_payload(
+            len(payloads) + 1, calms=calms, sleeps=sleeps,
+            first="Maximilianne-Josephine", last="Vanderhoeven-Castellanos",
+            street1="12345 North Bougainvillea Canyon Boulevard",
+            street2="Building 17, Suite 2400, Attention Receiving Department",
+            city="Rancho Santa Margarita"))
+    return payloads
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "runs": len(samples),
+        "mean": statistics.mean(samples),
+        "median": statistics.median(samples),
+        "p95": samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))],
+        "min": samples[0],
+        "max": samples[-1],
+    }
+
+
+def _timed(samples, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    samples.append(time.perf_counter() - start)
+    return result
+
+
+# moto is only a test requirement, it's imported when the s3_upload stage runs without S3_ENDPOINT_URL
+def _s3_stand_in():
+    if os.environ.get("S3_ENDPOINT_URL"):
+        return None
+    try:
+        import moto
+    except ImportError:
+        raise SystemExit("The s3_upload stage needs moto to stand in for S3, install requirements-test.txt "
+                         "or point S3_ENDPOINT_URL at an S3 server")
+    mock_aws = getattr(moto, "mock_aws", None) or moto.mock_s3
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    mock = mock_aws()
+    mock.start()
+    return mock
+
+
+def run_benchmarks(stages, repeat, payloads):
+    # renders happen in this process so the timings don't include the pool round trip
+    os.environ["RENDER_WORKERS"] = "0"
+    import application
+    import catalog
+    import render_context
+    import s3client
+
+    results = {stage: [] for stage in stages}
+    orders = [application.parse_shippments_items(payload)[0] for payload in payloads]
+    current = catalog.get_catalog()
+    template_data = [application.build_template_data(order, current.ingredients, current.ingredients_legend)
+                     for order in orders]
+
+    mock = None
+    if "s3_upload" in stages:
+        mock = _s3_stand_in()
+        s3client.get_client().create_bucket(Bucket=s3client.BUCKET_NAME)
+
+    try:
+        for _ in range(repeat):
+            if "parse_ingredients" in stages:
+                _timed(results["parse_ingredients"], catalog.parse_ingredients)
+            if "parse_ingredients_legend" in stages:
+                _timed(results["parse_ingredients_legend"], catalog.parse_ingredients_legend)
+
+            for payload, order, data in zip(payloads, orders, template_data):
+                if "parse_shippments_items" in stages:
+                    _timed(results["parse_shippments_items"], application.parse_shippments_items, payload)
+                if "build_template_data" in stages:
+                    _timed(results["build_template_data"], application.build_template_data,
+                           order, current.ingredients, current.ingredients_legend)
+                if "render_html" in stages:
+                    _timed(results["render_html"], render_context.render_html_string, "cards", data)
+                pdf = None
+                if "gen_pdf" in stages:
+                    pdf = _timed(results["gen_pdf"], render_context.gen_pdf_bytes, "cards", data)
+                if "gen_cards_pdf" in stages:
+                    pdf = _timed(results["gen_cards_pdf"], render_context.gen_cards_pdf_bytes, data)
+                if "s3_upload" in stages:
+                    _timed(results["s3_upload"], s3client.upload_pdfs_to_aws,
+                           {"cards.pdf": pdf or b"%PDF-1.7 benchmark" * 4096}, "benchmark/{}".format(order['uuid']))
+    finally:
+        if mock is not None:
+            mock.stop()
+
+    return {
+        "meta": {
+            "created_at": datetime.datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "payloads": len(payloads),
+            "repeat": repeat,
+        },
+        "stages": {stage: summarize(samples) for stage, samples in results.items() if samples},
+    }
+
+
+# returns the stages whose median got slower than the baseline by more than the threshold
+def compare(baseline, current, threshold=REGRESSION_THRESHOLD, min_seconds=REGRESSION_MIN_SECONDS):
+    regressions = []
+    for stage, stats in sorted(current["stages"].items()):
+        before = baseline["stages"].get(stage)
+        if before is None:
+            print("{:<26} {:>10.4f}s  (no baseline)".format(stage, stats["median"]))
+            continue
+        change = (stats["median"] - before["median"]) / before["median"] if before["median"] else 0.0
+        regressed = change > threshold and stats["median"] - before["median"] > min_seconds
+        print("{:<26} {:>10.4f}s  baseline {:>10.4f}s  {:>+7.1%}{}".format(
+            stage, stats["median"], before["median"], change, "  REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(stage)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each stage of the order pipeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run the benchmarks and write the results as json")
+    run.add_argument("--output", default="benchmark_results.json")
+    run.add_argument("--repeat", type=int, default=3)
+    run.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    run.add_argument("--quick", action="store_true", help="only benchmark a handful of payloads")
+    run.add_argument("--baseline", help="compare the results against this baseline afterwards")
+    run.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+
+    check = commands.add_parser("compare", help="compare results against a stored baseline")
+    check.add_argument("baseline")
+    check.add_argument("results")
+    check.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        payloads = make_payloads()
+        if args.quick:
+            payloads = payloads[::10]
+        results = run_benchmarks(args.stages, args.repeat, payloads)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Wrote {}".format(args.output))
+        if args.baseline is None:
+            return 0
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.results) as f:
+            results = json.load(f)
+
+    regressions = compare(baseline, results, args.threshold)
+    if regressions:
+        print("Regressed stages: {}".format(", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+import metrics
+
+INGREDIENTS_FILE_PATH = "./files/ingredients.xlsx"
+INGREDIENTS_LEGEND_FILE_PATH = "./files/ingredients_colors.xlsx"
+
+# compiled snapshots are written next to the xlsx files so a cold start can skip openpyxl
+WRITE_SNAPSHOTS = os.environ.get("CATALOG_WRITE_SNAPSHOTS", "1") == "1"
+SNAPSHOT_SUFFIX = ".catalog.json"
+# layout of the snapshot files, bump it when what they store changes
+SNAPSHOT_FORMAT = 1
+
+Catalog = namedtuple("Catalog", ["ingredients", "ingredients_legend"])
+
+# (mtime, size, sha256) of a workbook the last time it was loaded
+_FileState = namedtuple("_FileState", ["mtime", "size", "sha256"])
+
+_lock = threading.Lock()
+_catalog = None
+_states = {}
+
+
+# return specific products with their benefits
+def parse_ingredients(path=INGREDIENTS_FILE_PATH):
+    # only needed when there is no compiled snapshot, so it's imported here
+    from openpyxl import load_workbook
+    dict = {}
+    wb = load_workbook(filename=path, read_only=True)
+    sheet = wb["SleepZ"]
+    for row in sheet.iter_rows(min_row=4, max_row=sheet.max_row):
+        if row[1].value is None:
+            continue
+        key = row[1].value
+        key = key.lower().replace(" ", "").replace("z", "")
+
+        dict[key] = [
+            row[4].value,
+            row[5].value,
+            row[6].value
+        ]
+    sheet = wb["CalmZ"]
+    for row in sheet.iter_rows(min_row=4, max_row=sheet.max_row):
+        if row[1].value is None:
+            continue
+        key = row[1].value
+        key = key.lower().replace(" ", "").replace("z", "")
+
+        dict[key] = [
+            row[3].value,
+            row[4].value,
+            row[5].value
+        ]
+    wb.close()
+
+    return dict
+
+
+def parse_ingredients_legend(path=INGREDIENTS_LEGEND_FILE_PATH):
+    from openpyxl import load_workbook
+    wb = load_workbook(filename=path, read_only=True)
+    sheet = wb["all"]
+    names_map = {}
+    items = {
+        "calm30": [],
+        "calm32": [],
+        "calm34": [],
+        "calm36": [],
+        "calm38": [],
+        "calm40": [],
+        "sleep10": [],
+        "sleep12": [],
+        "sleep14": [],
+        "sleep16": [],
+        "sleep18": [],
+        "sleep20": [],
+        "all": []
+    }
+
+    for row in sheet.iter_rows(min_row=2, max_row=2):
+
+        for i in range(3, 15):
+            names_map[i] = row[i].value
+
+    for row in sheet.iter_rows(min_row=3, max_row=35):
+        color = row[1].value
+        name = row[2].value.lower()
+        pair = {"color": color, "name": name}
+        items["all"].append(pair)
+        for i in range(3, 15):
+
+            if (row[i].value == None):
+                continue
+            product = names_map[i]
+            items[product].append(pair)
+    wb.close()
+
+    return items
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# snapshots are only valid for the parsers that wrote them, so a change to this module invalidates them
+def _snapshot_version():
+    return "{}-{}".format(SNAPSHOT_FORMAT, _file_sha256(__file__)[:16])
+
+
+def _read_snapshot(path, sha256):
+    try:
+        with open(path + SNAPSHOT_SUFFIX) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if snapshot.get("sha256") != sha256 or snapshot.get("version") != _snapshot_version():
+        return None
+    return snapshot["data"]
+
+
+def _write_snapshot(path, sha256, data):
+    snapshot_path = path + SNAPSHOT_SUFFIX
+    tmp_path = "{}.{}.tmp".format(snapshot_path, os.getpid())
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump({"sha256": sha256, "version": _snapshot_version(), "data": data}, f)
+        os.replace(tmp_path, snapshot_path)
+    except OSError as e:
+        logging.error("Error writing catalog snapshot {} {}".format(snapshot_path, e))
+
+
+def _load_file(path, parse, state):
+    stat = os.stat(path)
+    sha256 = _file_sha256(path)
+    if state is not None and state.sha256 == sha256:
+        # touched but not modified, keep the data we already have
+        return None, _FileState(stat.st_mtime, stat.st_size, sha256)
+
+    data = _read_snapshot(path, sha256)
+    if data is None:
+        logging.info("Parsing workbook {}".format(path))
+        data = parse(path)
+        if WRITE_SNAPSHOTS:
+            _write_snapshot(path, sha256, data)
+    else:
+        logging.info("Loaded compiled catalog snapshot for {}".format(path))
+    return data, _FileState(stat.st_mtime, stat.st_size, sha256)
+
+
+def _is_stale(path):
+    state = _states.get(path)
+    if state is None:
+        return True
+    stat = os.stat(path)
+    return stat.st_mtime != state.mtime or stat.st_size != state.size
+
+
+def _freeze_ingredients(data):
+    return MappingProxyType({key: tuple(benefits) for key, benefits in data.items()})
+
+
+def _freeze_legend(data):
+    return MappingProxyType({
+        product: tuple(MappingProxyType(dict(pair)) for pair in pairs)
+        for product, pairs in data.items()
+    })
+
+
+def load_catalog():
+    global _catalog
+    with _lock, metrics.stage("ingredient_load"):
+        ingredients_state = _states.get(INGREDIENTS_FILE_PATH)
+        legend_state = _states.get(INGREDIENTS_LEGEND_FILE_PATH)
+        ingredients, _states[INGREDIENTS_FILE_PATH] = _load_file(
+            INGREDIENTS_FILE_PATH, parse_ingredients, ingredients_state)
+        legend, _states[INGREDIENTS_LEGEND_FILE_PATH] = _load_file(
+            INGREDIENTS_LEGEND_FILE_PATH, parse_ingredients_legend, legend_state)
+
+        if _catalog is None or ingredients is not None or legend is not None:
+            _catalog = Catalog(
+                _freeze_ingredients(ingredients) if ingredients is not None else _catalog.ingredients,
+                _freeze_legend(legend) if legend is not None else _catalog.ingredients_legend
+            )
+        return _catalog
+
+
+# returns the in-memory catalog, reloading it only when one of the workbooks changed on disk
+def get_catalog():
+    if (_catalog is None
+            or _is_stale(INGREDIENTS_FILE_PATH)
+            or _is_stale(INGREDIENTS_LEGEND_FILE_PATH)):
+        return load_catalog()
+    return _catalog
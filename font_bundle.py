@@ -0,0 +1,194 @@
+import os
+import re
+import sys
+import json
+import hashlib
+import logging
+import pathlib
+import argparse
+import catalog
+
+TEMPLATES_DIR = "./templates"
+# the instruction and faq texts are written in application.py
+STATIC_TEXT_FILES = ["./application.py"]
+STYLESHEETS = ["./css/cards.css", "./css/inserts.css"]
+# subset fonts and the manifest pointing the stylesheets at them
+FONTS_BUILD_DIR = os.environ.get("FONTS_BUILD_DIR", "./build/fonts")
+MANIFEST_NAME = "manifest.json"
+# build the subset fonts when the render pool starts, deploys that build them ahead can turn it off
+BUILD_ON_START = os.environ.get("FONTS_BUILD_ON_START", "1") == "1"
+# bump when the subsetting changes so every font gets rebuilt
+SUBSET_VERSION = 1
+
+# names and addresses come from customers, so besides the characters of the templates and the
+# catalog every font keeps printable ascii, latin-1, latin extended-a and the usual typographic marks
+CUSTOMER_CHARACTERS = "".join(
+    [chr(c) for c in range(0x20, 0x7f)]
+    + [chr(c) for c in range(0xa0, 0x180)]
+    + list("‘’‚“”„–—•…™€"))
+
+FONT_FACE_URL = re.compile(r"(@font-face\s*{[^}]*?src:\s*url\()([\"']?)([^\"')]+)\2(\))")
+
+# fonttools logs every table it prunes at info level
+logging.getLogger("fontTools.subset").setLevel(logging.WARNING)
+
+_prepared = False
+_manifest = None
+
+
+def _catalog_text():
+    current = catalog.get_catalog()
+    text = []
+    for key, benefits in current.ingredients.items():
+        text.append(key)
+        text.extend(str(benefit) for benefit in benefits if benefit is not None)
+    for pairs in current.ingredients_legend.values():
+        text.extend(str(pair["name"]) for pair in pairs)
+    return "".join(text)
+
+
+# every character the cards and inserts can print
+def used_characters(templates_dir=TEMPLATES_DIR):
+    characters = set(CUSTOMER_CHARACTERS)
+    paths = list(STATIC_TEXT_FILES)
+    for root, _, files in os.walk(templates_dir):
+        paths.extend(os.path.join(root, name) for name in files if name.endswith(".html"))
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            characters.update(f.read())
+    characters.update(_catalog_text())
+    # text-transform and |upper can change the case of anything
+    characters.update(c.upper() for c in list(characters))
+    characters.update(c.lower() for c in list(characters))
+    return "".join(sorted(c for c in characters if c.isprintable() or c == " "))
+
+
+def subset_font(path, characters, output_path):
+    from fontTools import subset
+    options = subset.Options()
+    options.layout_features = ["*"]
+    options.name_IDs = ["*"]
+    options.name_languages = ["*"]
+    options.notdef_outline = True
+    options.glyph_names = True
+    font = subset.load_font(path, options)
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(unicodes=[ord(c) for c in characters])
+    subsetter.subset(font)
+    tmp_path = "{}.{}.tmp".format(output_path, os.getpid())
+    subset.save_font(font, tmp_path, options)
+    font.close()
+    os.replace(tmp_path, output_path)
+
+
+def _file_sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# subsets every font the stylesheets declare with @font-face, returns the manifest mapping each
+# stylesheet to its font urls and the subset files replacing them
+def build_fonts(build_dir=FONTS_BUILD_DIR):
+    global _manifest
+    os.makedirs(build_dir, exist_ok=True)
+    characters = used_characters()
+    characters_sha256 = hashlib.sha256(characters.encode("utf-8")).hexdigest()
+    manifest = {"stylesheets": {}}
+    for stylesheet in STYLESHEETS:
+        with open(stylesheet) as f:
+            source = f.read()
+        fonts = {}
+        for match in FONT_FACE_URL.finditer(source):
+            url = match.group(3)
+            path = os.path.normpath(os.path.join(os.path.dirname(stylesheet), url))
+            key = hashlib.sha256("{}:{}:{}".format(
+                _file_sha256(path), characters_sha256, SUBSET_VERSION).encode("utf-8")).hexdigest()[:20]
+            output_name = "{}{}".format(key, os.path.splitext(path)[1])
+            output_path = os.path.join(build_dir, output_name)
+            if not os.path.exists(output_path):
+                subset_font(path, characters, output_path)
+                logging.info("Subset {} {} -> {} bytes".format(
+                    path, os.path.getsize(path), os.path.getsize(output_path)))
+            stat = os.stat(path)
+            fonts[url] = {"file": output_name, "source": path, "mtime": stat.st_mtime, "size": stat.st_size}
+        stat = os.stat(stylesheet)
+        manifest["stylesheets"][stylesheet] = {"mtime": stat.st_mtime, "size": stat.st_size, "fonts": fonts}
+
+    path = os.path.join(build_dir, MANIFEST_NAME)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+    _manifest = None
+    return manifest
+
+
+# builds the subset fonts once per process, before the render processes that load them start
+def prepare_fonts():
+    global _prepared
+    if _prepared or not BUILD_ON_START:
+        return
+    _prepared = True
+    try:
+        build_fonts()
+    except Exception as e:
+        logging.error("Error building subset fonts, rendering with the originals {}".format(e))
+
+
+def _read_manifest(build_dir):
+    global _manifest
+    if _manifest is None:
+        try:
+            with open(os.path.join(build_dir, MANIFEST_NAME)) as f:
+                _manifest = json.load(f)
+        except (OSError, ValueError):
+            _manifest = {}
+    return _manifest
+
+
+def _is_current(entry, path):
+    stat = os.stat(path)
+    return entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size
+
+
+# the stylesheet with its @font-face rules pointing at the subset fonts, or None when the subset
+# fonts weren't built or the stylesheet or one of its fonts changed since
+def stylesheet_source(stylesheet, build_dir=FONTS_BUILD_DIR):
+    entry = _read_manifest(build_dir).get("stylesheets", {}).get(stylesheet)
+    try:
+        if entry is None or not _is_current(entry, stylesheet):
+            return None
+        for font in entry["fonts"].values():
+            if not _is_current(font, font["source"]):
+                logging.warning("Subset font for {} is out of date, using the original".format(font["source"]))
+                return None
+    except OSError:
+        return None
+
+    def replace(match):
+        font = entry["fonts"].get(match.group(3))
+        if font is None:
+            return match.group(0)
+        url = pathlib.Path(os.path.abspath(os.path.join(build_dir, font["file"]))).as_uri()
+        return "{}{}{}{}{}".format(match.group(1), match.group(2), url, match.group(2), match.group(4))
+
+    with open(stylesheet) as f:
+        return FONT_FACE_URL.sub(replace, f.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Subset the fonts of the cards and inserts to the characters they print")
+    parser.add_argument("--output", default=FONTS_BUILD_DIR)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    manifest = build_fonts(args.output)
+    for stylesheet, entry in manifest["stylesheets"].items():
+        for font in entry["fonts"].values():
+            print("{} {} {} bytes -> {} bytes".format(stylesheet, font["source"], font["size"],
+                                                     os.path.getsize(os.path.join(args.output, font["file"]))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+import os
+import time
+import random
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "30"))
+MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", "4"))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+POOL_SIZE = 10
+
+SHIPSTATION_API_URL = os.environ.get("SHIPSTATION_API_URL", "https://ssapi.shipstation.com")
+
+# shipstation allows 40 requests per minute per api key
+SHIPSTATION_REQUESTS_PER_MINUTE = 40
+
+REBRANDLY_HEADERS = {
+    "Content-type": "application/json",
+    "apikey": os.environ.get("REBRANDLY_API_KEY", "bf0a166016c74d17afaffdd1656d9bef"),
+    "workspace": os.environ.get("REBRANDLY_WORKSPACE", "1562030ed25a4759b1922a5150e438ad")
+}
+
+SHIPSTATION_HEADERS = {
+    'Content-Type': 'application/json',
+    'Authorization': os.environ.get(
+        "SHIPSTATION_AUTHORIZATION",
+        'Basic ZGNiMDM5M2ZiNzU2NDQxYWJhZGEyOTA3NTc2YWMwODM6NWZiM2VkNTA0ZGY4NDQ3ODk2ZWZjN2M4OGEwZDI1OTI=')
+}
+
+
+# full jitter exponential backoff
+def backoff_delay(attempt):
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+# token bucket limiter, callers block in acquire() until a request may be sent, so bursts
+# queue up instead of running into 429s
+class TokenBucket:
+
+    def __init__(self, requests_per_minute):
+        self.capacity = float(requests_per_minute)
+        self.rate = requests_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    # the server knows about requests from other processes, so its X-Rate-Limit-* headers win
+    def update_from_headers(self, headers):
+        remaining = headers.get("X-Rate-Limit-Remaining")
+        reset = headers.get("X-Rate-Limit-Reset")
+        if remaining is None:
+            return
+        try:
+            remaining = int(remaining)
+            reset = float(reset) if reset is not None else 60.0
+        except ValueError:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if remaining <= 0:
+                # nothing may go out before the window resets, the first response after it resyncs the bucket
+                self.paused_until = max(self.paused_until, now + reset)
+                self.tokens = 1.0
+            else:
+                self.tokens = min(self.tokens, float(remaining))
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# keep-alive session with timeouts, jittered retries and an optional rate limiter
+class ApiClient:
+
+    def __init__(self, name, headers, limiter=None):
+        self.name = name
+        self.headers = headers
+        self.limiter = limiter
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # one session per process, sockets can't be shared with forked children
+    def _get_session(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    session.headers.update(self.headers)
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            try:
+                response = self._get_session().request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= MAX_RETRIES:
+                    raise
+                delay = backoff_delay(attempt)
+                logging.error("{} request failed {}, retrying in {:.2f}s".format(self.name, e, delay))
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            if self.limiter is not None:
+                self.limiter.update_from_headers(response.headers)
+            if response.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES:
+                return response
+
+            delay = backoff_delay(attempt)
+            retry_after = response.headers.get("Retry-After")
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            if response.status_code == 429 and self.limiter is not None:
+                self.limiter.pause(delay)
+            logging.error("{} answered {}, retrying in {:.2f}s".format(self.name, response.status_code, delay))
+            time.sleep(delay)
+            attempt += 1
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+rebrandly = ApiClient("Rebrandly", REBRANDLY_HEADERS)
+shipstation = ApiClient("ShipStation", SHIPSTATION_HEADERS,
+                        limiter=TokenBucket(SHIPSTATION_REQUESTS_PER_MINUTE))
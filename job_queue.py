@@ -0,0 +1,286 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+JOBS_DB_PATH = os.environ.get("JOBS_DB_PATH", "./prod/jobs.db")
+
+QUEUED = "queued"
+RENDERING = "rendering"
+UPLOADED = "uploaded"
+PUSHED = "pushed"
+# rendered in test mode, where nothing is uploaded or pushed
+RENDERED = "rendered"
+FAILED = "failed"
+
+# how often idle workers look for jobs enqueued by another process
+POLL_INTERVAL = 1.0
+# a job whose process hasn't renewed its claim for this many seconds is put back on the queue.
+# a pid can't tell, containers reuse them across restarts
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "60"))
+HEARTBEAT_INTERVAL = JOB_LEASE_SECONDS / 4
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL,
+        error TEXT,
+        claimed_by TEXT,
+        heartbeat_at REAL,
+        date_modified TEXT,
+        fingerprint TEXT,
+        timings TEXT NOT NULL DEFAULT '{}',
+        profile INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS jobs_order_id ON jobs (order_id, id);
+    CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+'''
+
+# columns added after the first release, created on databases that don't have them yet
+MIGRATIONS = {
+    "date_modified": "ALTER TABLE jobs ADD COLUMN date_modified TEXT",
+    "fingerprint": "ALTER TABLE jobs ADD COLUMN fingerprint TEXT",
+    "profile": "ALTER TABLE jobs ADD COLUMN profile INTEGER NOT NULL DEFAULT 0",
+    "heartbeat_at": "ALTER TABLE jobs ADD COLUMN heartbeat_at REAL",
+}
+
+
+# woocommerce sends date_modified as an iso timestamp of one timezone, so the strings order like the times
+def _is_stale(latest, date_modified):
+    return (latest is not None and latest["date_modified"] is not None and date_modified is not None
+            and date_modified < latest["date_modified"])
+
+
+def _is_redelivery(latest, date_modified, fingerprint):
+    return (latest is not None and latest["status"] != FAILED
+            and (latest["date_modified"] == date_modified or latest["fingerprint"] == fingerprint))
+
+
+def _status(row):
+    return {
+        "job_id": row["id"],
+        "order_id": row["order_id"],
+        "status": row["status"],
+        "error": row["error"],
+        "timings": json.loads(row["timings"]),
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+    }
+
+
+# a claimed job, the pipeline reports its progress through it
+class Job:
+
+    def __init__(self, queue, id, order_id, payload, created_at, profile=False):
+        self.queue = queue
+        self.id = id
+        self.order_id = order_id
+        self.payload = payload
+        self.profile = profile
+        self.timings = {QUEUED: round(time.time() - created_at, 4)}
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.time()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.timings[stage] = round(time.time() - start, 4)
+            if self.queue.observer is not None:
+                self.queue.observer(stage, time.time() - start, error)
+
+    def set_status(self, status, error=None):
+        self.queue.update(self.id, status, self.timings, error)
+
+
+# durable sqlite backed queue of orders waiting to be processed
+class JobQueue:
+
+    # observer is called with (stage, seconds, error) for every stage a job times
+    def __init__(self, path=JOBS_DB_PATH, observer=None):
+        self.path = path
+        self.observer = observer
+        self._wakeup = threading.Condition()
+        self._workers = []
+        self._owner = None
+        self._owner_pid = None
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+            columns = {row["name"] for row in db.execute("PRAGMA table_info(jobs)")}
+            for column, statement in MIGRATIONS.items():
+                if column not in columns:
+                    db.execute(statement)
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        try:
+            yield db
+        finally:
+            db.close()
+
+    # enqueues the order unless it's a redelivery of the order's latest job, pending or done: the
+    # same date_modified, or a fingerprint that matches because only fields the cards and shipstation
+    # don't use changed. a delivery older than the latest job is stale and ignored. returns the
+    # status of the job the delivery went to and whether it was created
+    def enqueue_once(self, order_id, payload, date_modified, fingerprint, profile=False):
+        now = time.time()
+        with self._connect() as db:
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                row = db.execute("SELECT * FROM jobs WHERE order_id = ? ORDER BY id DESC LIMIT 1",
+                                 (str(order_id),)).fetchone()
+                stale = _is_stale(row, date_modified)
+                if not stale and not _is_redelivery(row, date_modified, fingerprint):
+                    db.execute(
+                        "INSERT INTO jobs (order_id, payload, status, date_modified, fingerprint, profile, "
+                        "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (str(order_id), json.dumps(payload), QUEUED, date_modified, fingerprint, int(profile),
+                         now, now))
+                    row = db.execute("SELECT * FROM jobs WHERE id = last_insert_rowid()").fetchone()
+                    created = True
+                else:
+                    created = False
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        if created:
+            with self._wakeup:
+                self._wakeup.notify()
+        status = _status(row)
+        if stale:
+            status["stale"] = True
+        return status, created
+
+    # id of this process's claims, new in every process so a restarted process never passes for the
+    # one that claimed a job before it
+    @property
+    def owner(self):
+        if self._owner_pid != os.getpid():
+            self._owner = "{}-{}".format(os.getpid(), uuid.uuid4().hex)
+            self._owner_pid = os.getpid()
+        return self._owner
+
+    def claim(self):
+        with self._connect() as db:
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                row = db.execute(
+                    "SELECT id, order_id, payload, profile, created_at FROM jobs WHERE status = ? ORDER BY id LIMIT 1",
+                    (QUEUED,)).fetchone()
+                if row is None:
+                    db.execute("COMMIT")
+                    return None
+                now = time.time()
+                db.execute("UPDATE jobs SET status = ?, claimed_by = ?, heartbeat_at = ?, updated_at = ? WHERE id = ?",
+                           (RENDERING, self.owner, now, now, row["id"]))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return Job(self, row["id"], row["order_id"], json.loads(row["payload"]), row["created_at"],
+                   bool(row["profile"]))
+
+    def update(self, job_id, status, timings, error=None):
+        with self._connect() as db:
+            db.execute("UPDATE jobs SET status = ?, timings = ?, error = ?, updated_at = ? WHERE id = ?",
+                       (status, json.dumps(timings), error, time.time(), job_id))
+
+    def status(self, order_id):
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE order_id = ? ORDER BY id DESC LIMIT 1",
+                             (str(order_id),)).fetchone()
+        if row is None:
+            return None
+        return _status(row)
+
+    # payload of the last delivery of the order, None for an order that was never queued
+    def payload(self, order_id):
+        with self._connect() as db:
+            row = db.execute("SELECT payload FROM jobs WHERE order_id = ? ORDER BY id DESC LIMIT 1",
+                             (str(order_id),)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row["payload"])
+
+    def depth(self):
+        with self._connect() as db:
+            return db.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+
+    # renews the claims of this process on the jobs it's still working on
+    def heartbeat(self):
+        with self._connect() as db:
+            db.execute("UPDATE jobs SET heartbeat_at = ? WHERE claimed_by = ? AND status IN (?, ?)",
+                       (time.time(), self.owner, RENDERING, UPLOADED))
+
+    # jobs whose process stopped renewing its claim, because it died or was restarted, are put back
+    # on the queue
+    def requeue_interrupted(self):
+        expired = time.time() - JOB_LEASE_SECONDS
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) AND claimed_by IS NOT ? "
+                "AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+                (RENDERING, UPLOADED, self.owner, expired)).fetchall()
+            for row in rows:
+                logging.info("Requeueing interrupted job {}".format(row["id"]))
+                db.execute("UPDATE jobs SET status = ?, claimed_by = NULL, heartbeat_at = NULL, updated_at = ? "
+                           "WHERE id = ?", (QUEUED, time.time(), row["id"]))
+
+    def _keep_claims(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            try:
+                self.heartbeat()
+                self.requeue_interrupted()
+            except sqlite3.Error as e:
+                logging.error("Error renewing job claims {}".format(e))
+
+    def _work(self, handler):
+        while True:
+            try:
+                job = self.claim()
+            except sqlite3.Error as e:
+                logging.error("Error claiming job {}".format(e))
+                job = None
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(POLL_INTERVAL)
+                continue
+
+            logging.info("Start processing job {} for order {}".format(job.id, job.order_id))
+            try:
+                handler(job)
+            except Exception as e:
+                logging.exception("Error processing job {} for order {}".format(job.id, job.order_id))
+                job.set_status(FAILED, "{}: {}".format(type(e).__name__, e))
+            logging.info("Finished processing job {} for order {}".format(job.id, job.order_id))
+
+    def start_workers(self, count, handler):
+        if self._workers:
+            return
+        self.requeue_interrupted()
+        threading.Thread(target=self._keep_claims, name="order-heartbeat", daemon=True).start()
+        for i in range(count):
+            worker = threading.Thread(target=self._work, args=(handler,),
+                                      name="order-worker-{}".format(i), daemon=True)
+            worker.start()
+            self._workers.append(worker)
@@ -0,0 +1,139 @@
+import os
+import time
+import sqlite3
+import logging
+import argparse
+from contextlib import contextmanager
+
+LEDGER_DB_PATH = os.environ.get("LEDGER_DB_PATH", "./prod/ledger.db")
+# the shipments workbook and the copy of it the export writes the cards links into
+SHIPMENTS_FILE = "./files/shipments.xlsx"
+PROCESSED_FILE_PATH = "./prod/shipments_processed.xlsx"
+
+# columns of the Orders sheet the export fills in, in sheet order
+SHEET_COLUMNS = [
+    "first", "last", "email", None, "street1", "street2", "city", "state", "zip", "order_id", "pack",
+    "sleep1", "sleep2", "calm1", "calm2", "order_number", "date_order", None, "cards_signed_url"
+]
+UID_COLUMN = 9
+PDF_LINKS_COLUMN = 18
+
+FIELDS = [
+    "first", "last", "email", "street1", "street2", "city", "state", "zip", "pack",
+    "sleep1", "sleep2", "calm1", "calm2", "order_number", "date_order",
+    "cards_signed_url", "inserts_signed_url", "short_url",
+    "shipstation_status", "shipstation_order_id", "shipstation_response"
+]
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS orders (
+        order_id TEXT PRIMARY KEY,
+        {},
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS orders_updated_at ON orders (updated_at);
+'''.format(",\n        ".join("{} TEXT".format(field) for field in FIELDS))
+
+
+# sqlite ledger of processed orders, their pdf urls and what shipstation answered
+class Ledger:
+
+    def __init__(self, path=LEDGER_DB_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        try:
+            yield db
+        finally:
+            db.close()
+
+    # inserts the order or updates only the given fields of an existing one
+    def upsert(self, order_id, **fields):
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ValueError("Unknown ledger fields {}".format(sorted(unknown)))
+
+        now = time.time()
+        columns = list(fields)
+        values = [None if fields[column] is None else str(fields[column]) for column in columns]
+        updates = ", ".join("{0} = excluded.{0}".format(column) for column in columns + ["updated_at"])
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO orders (order_id, {}created_at, updated_at) VALUES (?, {}?, ?) "
+                "ON CONFLICT (order_id) DO UPDATE SET {}".format(
+                    "".join(column + ", " for column in columns),
+                    "?, " * len(columns),
+                    updates),
+                [str(order_id)] + values + [now, now])
+
+    def get(self, order_id):
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM orders WHERE order_id = ?", (str(order_id),)).fetchone()
+        return dict(row) if row is not None else None
+
+    def orders(self):
+        with self._connect() as db:
+            for row in db.execute("SELECT * FROM orders ORDER BY created_at"):
+                yield dict(row)
+
+
+# writes the ledger into a copy of the shipments workbook: rows already in the sheet get
+# their pdf link, orders that came in through the webhook are appended
+def export_xlsx(ledger, shipments_path, output_path):
+    from openpyxl import load_workbook
+
+    orders = {order['order_id']: order for order in ledger.orders()}
+    wb = load_workbook(filename=shipments_path)
+    sheet = wb['Orders']
+    last_row = 1
+    for row in sheet.iter_rows(min_row=2):
+        if row[1].value is None:
+            continue
+        last_row = row[0].row
+        uuid = str(row[UID_COLUMN].value)
+        order = orders.pop(uuid, None)
+        if order is not None and order['cards_signed_url']:
+            row[PDF_LINKS_COLUMN].value = order['cards_signed_url']
+
+    for order in orders.values():
+        last_row += 1
+        for column, field in enumerate(SHEET_COLUMNS, start=1):
+            if field is not None:
+                sheet.cell(row=last_row, column=column, value=order[field])
+
+    tmp_path = output_path + ".tmp"
+    wb.save(filename=tmp_path)
+    os.replace(tmp_path, output_path)
+    logging.info("Exported ledger to {}".format(output_path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the order ledger to the processed shipments workbook")
+    parser.add_argument("--ledger", default=LEDGER_DB_PATH)
+    parser.add_argument("--shipments", default=SHIPMENTS_FILE)
+    parser.add_argument("--output", default=PROCESSED_FILE_PATH)
+    parser.add_argument("--every", type=float, default=None,
+                        help="keep exporting every EVERY seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    ledger = Ledger(args.ledger)
+    while True:
+        export_xlsx(ledger, args.shipments, args.output)
+        if args.every is None:
+            break
+        time.sleep(args.every)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import time
+import threading
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+STAGE_LATENCY = Histogram("zippz_stage_duration_seconds", "Time spent in each stage of the order pipeline",
+                          ["stage"], buckets=LATENCY_BUCKETS)
+STAGE_ERRORS = Counter("zippz_stage_errors_total", "Errors raised or reported by each stage of the order pipeline",
+                       ["stage"])
+RENDERS_IN_FLIGHT = Gauge("zippz_renders_in_flight", "Cards pdfs being rendered right now")
+QUEUE_DEPTH = Gauge("zippz_queue_depth", "Orders waiting in the job queue")
+ARTIFACT_STORE_BYTES = Gauge("zippz_artifact_store_bytes", "Size of the rendered pdfs kept in the artifact store")
+RENDERS_WAITING = Gauge("zippz_renders_waiting", "Renders waiting for a free render slot")
+RENDERS_REJECTED = Counter("zippz_renders_rejected_total", "Renders turned away because the render wait queue was full")
+RENDER_CONCURRENCY_LIMIT = Gauge("zippz_render_concurrency_limit", "Renders allowed to run at the same time")
+RENDER_QUEUE_LIMIT = Gauge("zippz_render_queue_limit", "Renders allowed to wait for a slot before requests get a 503")
+RENDER_WORKER_RSS_LIMIT = Gauge("zippz_render_worker_rss_limit_bytes",
+                                "Resident memory after which the render workers are recycled, 0 for no limit")
+RENDER_WORKER_MAX_TASKS = Gauge("zippz_render_worker_max_tasks",
+                                "Renders after which a render worker is replaced, 0 for never")
+RENDER_WORKER_RSS = Histogram("zippz_render_worker_rss_bytes", "Resident memory of a render worker after a render",
+                              buckets=(128e6, 256e6, 384e6, 512e6, 768e6, 1024e6, 1536e6, 2048e6, 4096e6))
+RENDER_WORKERS_RECYCLED = Counter("zippz_render_workers_recycled_total",
+                                  "Times the render workers were replaced for going over the memory limit")
+PDF_BYTES = Histogram("zippz_pdf_bytes", "Size of the rendered cards pdfs",
+                      buckets=(64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6, 16e6, 32e6))
+PDF_PAGES = Histogram("zippz_pdf_pages", "Pages of the rendered cards pdfs", buckets=(1, 2, 4, 6, 8, 10, 12, 16))
+
+# observations made in a render pool process are collected here and replayed in the web process,
+# whose registry is the one /metrics exposes
+_local = threading.local()
+
+
+def _collect(observation):
+    collected = getattr(_local, "collected", None)
+    if collected is not None:
+        collected.append(observation)
+
+
+def observe_stage(stage, seconds, error=False):
+    STAGE_LATENCY.labels(stage).observe(seconds)
+    if error:
+        STAGE_ERRORS.labels(stage).inc()
+    _collect(("stage", stage, seconds, error))
+
+
+def count_error(stage):
+    STAGE_ERRORS.labels(stage).inc()
+    _collect(("error", stage))
+
+
+def observe_pdf(pdf, pages):
+    PDF_BYTES.observe(len(pdf))
+    PDF_PAGES.observe(pages)
+    _collect(("pdf", len(pdf), pages))
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        observe_stage(name, time.perf_counter() - start, error)
+
+
+@contextmanager
+def collect_observations():
+    _local.collected = []
+    try:
+        yield _local.collected
+    finally:
+        _local.collected = None
+
+
+def replay(observations):
+    for observation in observations:
+        if observation[0] == "stage":
+            STAGE_LATENCY.labels(observation[1]).observe(observation[2])
+            if observation[3]:
+                STAGE_ERRORS.labels(observation[1]).inc()
+        elif observation[0] == "error":
+            STAGE_ERRORS.labels(observation[1]).inc()
+        elif observation[0] == "pdf":
+            PDF_BYTES.observe(observation[1])
+            PDF_PAGES.observe(observation[2])
+
+
+def latest():
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,83 @@
+import os
+import io
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from render_pool import RENDER_MAX_RSS_MB
+
+# bytes of static pages a render process keeps. the cache lives in the render workers, which are
+# replaced with their caches once one grows past RENDER_MAX_RSS_MB, so by default it only takes a
+# quarter of that
+PAGE_CACHE_MAX_BYTES = int(os.environ.get("PAGE_CACHE_MAX_BYTES", "0")) or (RENDER_MAX_RSS_MB or 1024) * 1024 * 1024 // 4
+
+# the personalized document is pages 1-3 and 8, the cached static pages go after page 3
+STATIC_PAGES_POSITION = 3
+
+
+# the static pages only depend on the products, so the key is the sorted product ids of every
+# issue plus a hash of the product data in case the ingredients catalog changes
+def combination_key(issues):
+    ids = "+".join("{}-{}".format(issue['product1']['id'], issue['product2']['id']) for issue in issues)
+    digest = hashlib.sha1(json.dumps(issues, sort_keys=True, default=list).encode("utf-8")).hexdigest()
+    return "{}:{}".format(ids, digest[:12])
+
+
+# keeps the rendered static pages of the most recently used product combinations
+class PageCache:
+
+    def __init__(self, max_bytes=PAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            pdf = self._entries.get(key)
+            if pdf is not None:
+                self._entries.move_to_end(key)
+            return pdf
+
+    def put(self, key, pdf):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            self._entries[key] = pdf
+            self._bytes += len(pdf)
+            # the newest entry is kept even when it alone is over the limit
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    @property
+    def size(self):
+        return self._bytes
+
+
+# inserts the static pages into the personalized document at the given page position,
+# returns the merged pdf and its page count
+def stitch_pages(personalized_pdf, static_pdf, position=STATIC_PAGES_POSITION):
+    from pypdf import PdfReader, PdfWriter
+    personalized = PdfReader(io.BytesIO(personalized_pdf))
+    static = PdfReader(io.BytesIO(static_pdf))
+    writer = PdfWriter()
+    for page in personalized.pages[:position]:
+        writer.add_page(page)
+    for page in static.pages:
+        writer.add_page(page)
+    for page in personalized.pages[position:]:
+        writer.add_page(page)
+
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue(), len(writer.pages)
+
+
+page_cache = PageCache()
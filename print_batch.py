@@ -0,0 +1,413 @@
+import io
+import os
+import sys
+import zlib
+import hashlib
+import logging
+import argparse
+import datetime
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pypdf import PdfReader
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NumberObject, StreamObject
+
+PRINT_BATCH_PATH = "./prod/print_batch.pdf"
+
+# printer sheets in pdf points, portrait. imposed pages are turned landscape when more cards fit
+SHEET_SIZES = {
+    "letter": (612, 792),
+    "legal": (612, 1008),
+    "tabloid": (792, 1224),
+    "a4": (595.28, 841.89),
+    "a3": (841.89, 1190.55),
+}
+# cards per sheet => columns and rows of a portrait sheet
+LAYOUTS = {1: (1, 1), 2: (1, 2), 4: (2, 2)}
+# orders whose cards are rendered or looked up ahead of the one being written
+RENDER_AHEAD = 4
+# objects the writer remembers to write the pages every order shares (the static cards pages,
+# their images and fonts) only once. bounded so a batch of any size runs in the same memory
+DEDUPE_ENTRIES = 50000
+
+
+def _number(value):
+    return ("%.4f" % value).rstrip("0").rstrip(".").encode("ascii")
+
+
+def _text(value):
+    text = str(value or "").encode("cp1252", "replace")
+    return b"(" + text.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+# refs maps the object numbers of one source pdf to the output's, importing holds the objects
+# being copied so a reference cycle doesn't recurse forever
+class _Source:
+
+    def __init__(self):
+        self.refs = {}
+        self.importing = set()
+
+
+# writes a pdf front to back and hands out what it wrote so far, so a batch can be saved or sent
+# while it's being built. only the offsets of the objects and the page numbers are kept
+class StreamingPdfWriter:
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self._offsets = array("Q", [0])
+        self._pages = array("Q")
+        self._written = OrderedDict()
+        self._font = None
+        self._catalog = self._allocate()
+        self._page_tree = self._allocate()
+        self._write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write(self, data):
+        self._chunks.append(data)
+        self._position += len(data)
+
+    # the bytes written since the last call
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+    def _allocate(self):
+        self._offsets.append(0)
+        return len(self._offsets) - 1
+
+    def _write_object(self, number, body, data=None):
+        self._offsets[number] = self._position
+        self._write(b"%d 0 obj\n" % number)
+        self._write(body)
+        if data is not None:
+            self._write(b"\nstream\n")
+            self._write(data)
+            self._write(b"\nendstream")
+        self._write(b"\nendobj\n")
+
+    # writes the object unless an identical one was written recently, returns its number
+    def _write_once(self, body, data=None):
+        digest = hashlib.sha256(body)
+        if data is not None:
+            digest.update(data)
+        digest = digest.digest()
+        number = self._written.get(digest)
+        if number is not None:
+            self._written.move_to_end(digest)
+            return number
+        number = self._allocate()
+        self._write_object(number, body, data)
+        self._written[digest] = number
+        if len(self._written) > DEDUPE_ENTRIES:
+            self._written.popitem(last=False)
+        return number
+
+    def _write_stream(self, entries, data):
+        return self._write_once(b"<<" + entries + b"/Length %d>>" % len(data), data)
+
+    def _serialize(self, value, source):
+        if isinstance(value, IndirectObject):
+            return b"%d 0 R" % self._import(value, source)
+        if isinstance(value, DictionaryObject):
+            return b"<<" + self._entries(value, source) + b">>"
+        if isinstance(value, ArrayObject):
+            return b"[" + b" ".join(self._serialize(item, source) for item in value) + b"]"
+        if isinstance(value, NumberObject):
+            return b"%d" % value
+        output = io.BytesIO()
+        value.write_to_stream(output)
+        return output.getvalue()
+
+    def _entries(self, dictionary, source, skip=("/Length", "/Parent")):
+        return b"".join(self._serialize(key, source) + b" " + self._serialize(value, source)
+                        for key, value in dictionary.items() if key not in skip)
+
+    # copies an object of the source pdf and everything it references, returns its number
+    def _import(self, reference, source):
+        key = (reference.idnum, reference.generation)
+        number = source.refs.get(key)
+        if number is not None:
+            return number
+        if key in source.importing:
+            # referenced by one of the objects it references, it gets its number now
+            number = source.refs[key] = self._allocate()
+            return number
+
+        source.importing.add(key)
+        value = reference.get_object()
+        if isinstance(value, StreamObject):
+            body, data = b"<<" + self._entries(value, source) + b"/Length %d>>" % len(value._data), value._data
+        else:
+            body, data = self._serialize(value, source), None
+        source.importing.discard(key)
+
+        number = source.refs.get(key)
+        if number is None:
+            number = source.refs[key] = self._write_once(body, data)
+        else:
+            self._write_object(number, body, data)
+        return number
+
+    # copies a page of the source pdf as a form xobject, returns its number and its media box
+    def import_page(self, page, source):
+        box = [float(value) for value in page.mediabox]
+        contents = page.get("/Contents")
+        contents = contents.get_object() if contents is not None else None
+        if contents is None:
+            parts = []
+        elif isinstance(contents, ArrayObject):
+            parts = [part.get_object().get_data() for part in contents]
+        else:
+            parts = [contents.get_data()]
+        resources = page.get("/Resources")
+        entries = b"/Type/XObject/Subtype/Form/BBox[" + b" ".join(_number(value) for value in box) + b"]"
+        if resources is not None:
+            entries += b"/Resources " + self._serialize(resources, source)
+        return self._write_stream(entries + b"/Filter/FlateDecode", zlib.compress(b"\n".join(parts))), box
+
+    def font(self):
+        if self._font is None:
+            self._font = self._write_once(b"<</Type/Font/Subtype/Type1/BaseFont/Helvetica/Encoding/WinAnsiEncoding>>")
+        return self._font
+
+    # adds a page drawing the given form xobjects, and the font of font() as /F1
+    def add_page(self, width, height, content, forms=(), font=False):
+        resources = b""
+        if forms:
+            resources += b"/XObject<<" + b"".join(b"/P%d %d 0 R" % (number, number) for number in forms) + b">>"
+        if font:
+            resources += b"/Font<</F1 %d 0 R>>" % self.font()
+        contents = self._write_stream(b"/Filter/FlateDecode", zlib.compress(content))
+        number = self._allocate()
+        self._write_object(number, b"<</Type/Page/Parent %d 0 R/MediaBox[0 0 %s %s]/Resources<<%s>>/Contents %d 0 R>>" % (
+            self._page_tree, _number(width), _number(height), resources, contents))
+        self._pages.append(number)
+
+    @property
+    def page_count(self):
+        return len(self._pages)
+
+    def close(self):
+        self._write_object(self._page_tree, b"<</Type/Pages/Count %d/Kids[" % len(self._pages)
+                           + b" ".join(b"%d 0 R" % number for number in self._pages) + b"]>>")
+        self._write_object(self._catalog, b"<</Type/Catalog/Pages %d 0 R>>" % self._page_tree)
+        xref = self._position
+        self._write(b"xref\n0 %d\n0000000000 65535 f \n" % len(self._offsets))
+        for start in range(1, len(self._offsets), 4096):
+            self._write(b"".join(b"%010d 00000 n \n" % offset for offset in self._offsets[start:start + 4096]))
+        self._write(b"trailer\n<</Size %d/Root %d 0 R>>\nstartxref\n%d\n%%%%EOF\n" % (
+            len(self._offsets), self._catalog, xref))
+
+
+# lays the cards pages out n to a printer sheet, scaled down when they don't fit at full size
+class Imposition:
+
+    def __init__(self, writer, sheet=None, n_up=1):
+        if n_up not in LAYOUTS:
+            raise ValueError("Cards per sheet must be one of {}".format(sorted(LAYOUTS)))
+        if sheet is not None and sheet not in SHEET_SIZES:
+            raise ValueError("Sheet must be one of {}".format(sorted(SHEET_SIZES)))
+        self.writer = writer
+        # without a sheet every page is printed on its own, at its own size
+        self.sheet = SHEET_SIZES[sheet] if sheet is not None else None
+        self.n_up = n_up if sheet is not None else 1
+        self._size = None
+        self._slots = None
+        self._placed = []
+
+    # the orientation of the sheet fitting the biggest cards, the first page decides it
+    def _layout(self, width, height):
+        columns, rows = LAYOUTS[self.n_up]
+        best = None
+        for sheet_width, sheet_height, columns, rows in ((self.sheet[0], self.sheet[1], columns, rows),
+                                                         (self.sheet[1], self.sheet[0], rows, columns)):
+            cell_width, cell_height = sheet_width / columns, sheet_height / rows
+            scale = min(cell_width / width, cell_height / height, 1)
+            if best is None or scale > best[0]:
+                slots = [(column * cell_width, sheet_height - (row + 1) * cell_height, cell_width, cell_height)
+                         for row in range(rows) for column in range(columns)]
+                best = (scale, (sheet_width, sheet_height), slots)
+        return best[1], best[2]
+
+    def place(self, form, box):
+        width, height = box[2] - box[0], box[3] - box[1]
+        if self.sheet is None:
+            self.writer.add_page(width, height, b"q 1 0 0 1 %s %s cm /P%d Do Q" % (
+                _number(-box[0]), _number(-box[1]), form), [form])
+            return
+        if self._slots is None:
+            self._size, self._slots = self._layout(width, height)
+        x, y, cell_width, cell_height = self._slots[len(self._placed)]
+        scale = min(cell_width / width, cell_height / height, 1)
+        x += (cell_width - width * scale) / 2 - box[0] * scale
+        y += (cell_height - height * scale) / 2 - box[1] * scale
+        self._placed.append((form, b"q %s 0 0 %s %s %s cm /P%d Do Q" % (
+            _number(scale), _number(scale), _number(x), _number(y), form)))
+        if len(self._placed) == len(self._slots):
+            self.finish_sheet()
+
+    def finish_sheet(self):
+        if self._placed:
+            self.writer.add_page(self._size[0], self._size[1], b"\n".join(content for _, content in self._placed),
+                                 sorted(set(form for form, _ in self._placed)))
+            self._placed = []
+
+    # a sheet naming the order, the next order's cards start on the sheet after it
+    def separator(self, lines, box):
+        self.finish_sheet()
+        width, height = box[2] - box[0], box[3] - box[1]
+        if self.sheet is not None:
+            if self._slots is None:
+                self._size, self._slots = self._layout(width, height)
+            width, height = self._size
+        content = [b"BT /F1 18 Tf 22 TL 36 %s Td" % _number(height - 54)]
+        content.extend(_text(line) + b" '" for line in lines)
+        content.append(b"ET")
+        self.writer.add_page(width, height, b"\n".join(content), font=True)
+
+
+def _separator_lines(shippment, pages):
+    return [
+        "Order {}".format(shippment['uuid']),
+        "{} {}".format(shippment.get('first') or "", shippment.get('last') or "").strip(),
+        "{}, {} {}".format(shippment.get('city') or "", shippment.get('state') or "", shippment.get('zip') or ""),
+        "Ordered {}".format(shippment.get('date_order') or ""),
+        "{} pages".format(pages),
+    ]
+
+
+# the cards pdf of each shipment, looked up a few orders ahead so renders of orders missing from
+# the artifact store overlap with the writing
+def _cards_pdfs(shippments, cards_pdf, workers=RENDER_AHEAD):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for shippment in shippments:
+            pending.append((shippment, executor.submit(cards_pdf, shippment)))
+            if len(pending) > workers:
+                yield _result(*pending.popleft())
+        while pending:
+            yield _result(*pending.popleft())
+
+
+def _result(shippment, future):
+    try:
+        return shippment, future.result()
+    except Exception as e:
+        logging.error("Error getting the cards pdf of order {} {}".format(shippment['uuid'], e))
+        return shippment, None
+
+
+# merges the cards of the shipments into one print job and yields it in chunks as it's written.
+# cards_pdf(shippment) returns the shipment's cards pdf opened for reading, or None to leave it out
+def build_print_batch(shippments, cards_pdf, sheet=None, n_up=1, separators=False):
+    writer = StreamingPdfWriter()
+    layout = Imposition(writer, sheet, n_up)
+    orders = 0
+    for shippment, stored in _cards_pdfs(shippments, cards_pdf):
+        if stored is None:
+            logging.error("Leaving order {} out of the print batch, it has no cards pdf".format(shippment['uuid']))
+            continue
+        source = _Source()
+        with stored as f:
+            pages = PdfReader(f).pages
+            if separators:
+                layout.separator(_separator_lines(shippment, len(pages)), [float(value) for value in pages[0].mediabox])
+            for page in pages:
+                layout.place(*writer.import_page(page, source))
+        orders += 1
+        yield writer.take()
+    layout.finish_sheet()
+    writer.close()
+    logging.info("Print batch of {} orders, {} sheets".format(orders, writer.page_count))
+    yield writer.take()
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date() if value else None
+
+
+def _in_range(date_order, start, end):
+    try:
+        day = datetime.datetime.strptime(date_order, "%m/%d/%Y").date()
+    except (TypeError, ValueError):
+        return False
+    return (start is None or day >= start) and (end is None or day <= end)
+
+
+def _ledger_shippment(order):
+    created = datetime.datetime.strptime(order['date_order'], "%m/%d/%Y")
+    return dict(order, uuid=order['order_id'], date_title=created.strftime('%B %d, %Y'))
+
+
+# shipments of the ledger, the given orders in the given order or every order placed between
+# start and end (inclusive) in the order they came in
+def ledger_shippments(ledger, order_ids=None, start=None, end=None):
+    if order_ids:
+        for order_id in order_ids:
+            order = ledger.get(order_id)
+            if order is None:
+                logging.warning("Order {} is not in the ledger".format(order_id))
+                continue
+            yield _ledger_shippment(order)
+        return
+    for order in ledger.orders():
+        if _in_range(order['date_order'], start, end):
+            yield _ledger_shippment(order)
+
+
+def shipments_file_shippments(path, order_ids=None, start=None, end=None):
+    from batch import read_shippments
+    wanted = set(str(order_id) for order_id in order_ids) if order_ids else None
+    for shippment in read_shippments(path):
+        if wanted is not None:
+            if shippment['uuid'] in wanted:
+                yield shippment
+        elif _in_range(shippment['date_order'], start, end):
+            yield shippment
+
+
+# the cards pdf of the shipment in the artifact store opened for reading. the application module is
+# only imported to render an order that isn't stored, it loads the catalog and opens the job queue
+def stored_cards_pdf(shippment):
+    from artifact_store import artifacts
+    stored = artifacts.open(shippment['uuid'], "cards.pdf")
+    if stored is None:
+        from application import stored_cards_pdf as render_cards_pdf
+        stored = render_cards_pdf(shippment)
+    return stored
+
+
+def main():
+    from ledger import Ledger, SHIPMENTS_FILE
+
+    parser = argparse.ArgumentParser(description="Merge the cards of many orders into one pdf to print")
+    parser.add_argument("--order-id", action="append", dest="order_ids", help="order to print, can be repeated")
+    parser.add_argument("--from", dest="start", type=parse_date, help="first order date, YYYY-MM-DD")
+    parser.add_argument("--to", dest="end", type=parse_date, help="last order date, YYYY-MM-DD")
+    parser.add_argument("--source", choices=["ledger", "shipments"], default="ledger")
+    parser.add_argument("--shipments", default=SHIPMENTS_FILE)
+    parser.add_argument("--sheet", choices=sorted(SHEET_SIZES), default=None,
+                        help="printer sheet, without it every card page is printed at its own size")
+    parser.add_argument("--n-up", type=int, choices=sorted(LAYOUTS), default=1, help="cards per sheet")
+    parser.add_argument("--separators", action="store_true", help="print a sheet naming each order before its cards")
+    parser.add_argument("--output", default=PRINT_BATCH_PATH)
+    args = parser.parse_args()
+
+    if args.source == "ledger":
+        shippments = ledger_shippments(Ledger(), args.order_ids, args.start, args.end)
+    else:
+        shippments = shipments_file_shippments(args.shipments, args.order_ids, args.start, args.end)
+    tmp_path = args.output + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for chunk in build_print_batch(shippments, stored_cards_pdf, args.sheet, args.n_up, args.separators):
+            f.write(chunk)
+    os.replace(tmp_path, args.output)
+    print("Wrote {}".format(args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
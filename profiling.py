@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import hmac
+import time
+import random
+import cProfile
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+# every profiled run writes <timestamp>-<name>-<pid>.{pstats,collapsed,json} under <reports dir>/<order id>/
+PROFILE_REPORTS_DIR = os.environ.get("PROFILE_REPORTS_DIR", "./prod/profiles")
+# fraction of orders that get profiled without being asked to
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+# orders posted with this value in the X-Profile-Token header get profiled, unset disables the header
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+PROFILE_HEADER = "X-Profile-Token"
+# json file overriding sample_rate and token, re-read whenever it changes so profiling can be
+# turned on and off in production without a restart
+PROFILE_CONTROL_PATH = os.environ.get("PROFILE_CONTROL_PATH", "./prod/profiling.json")
+# seconds between two stack samples of the profiled thread
+SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.005"))
+
+_defaults = {"sample_rate": PROFILE_SAMPLE_RATE, "token": PROFILE_TOKEN}
+_control = None
+_local = threading.local()
+_install_lock = threading.Lock()
+_installed = False
+
+
+def settings():
+    global _control
+    try:
+        mtime = os.stat(PROFILE_CONTROL_PATH).st_mtime
+    except OSError:
+        return _defaults
+    if _control is None or _control[0] != mtime:
+        try:
+            with open(PROFILE_CONTROL_PATH) as f:
+                overrides = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error("Error reading profiling settings {} {}".format(PROFILE_CONTROL_PATH, e))
+            overrides = {}
+        _control = (mtime, dict(_defaults, **overrides))
+    return _control[1]
+
+
+# whether the request asked for its order to be profiled
+def requested(headers):
+    token = settings().get("token")
+    value = headers.get(PROFILE_HEADER)
+    # compared as bytes, compare_digest raises on str values that aren't ascii
+    return bool(token) and value is not None and hmac.compare_digest(value.encode("utf-8"), token.encode("utf-8"))
+
+
+def sampled():
+    rate = settings().get("sample_rate") or 0
+    return rate > 0 and random.random() < rate
+
+
+# weasyprint announces each rendering step on its progress logger, the time until the next
+# announcement (or the end of the render) is the time spent in that step
+class _StepHandler(logging.Handler):
+
+    def emit(self, record):
+        steps = getattr(_local, "steps", None)
+        if steps is not None:
+            # "Step 5 - Creating layout - Page %d" -> "Step 5 - Creating layout"
+            steps.append((time.perf_counter(), " - ".join(str(record.msg).split(" - ")[:2])))
+
+
+def _install_step_handler():
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        progress = logging.getLogger("weasyprint.progress")
+        progress.addHandler(_StepHandler())
+        progress.setLevel(logging.INFO)
+        # the steps are only wanted in the reports, not in the application log
+        progress.propagate = False
+        _installed = True
+
+
+# adds the time of each weasyprint step of one render to the profile running on this thread
+@contextmanager
+def weasyprint_render(template_name):
+    report = getattr(_local, "report", None)
+    if report is None:
+        yield
+        return
+
+    _local.steps = []
+    try:
+        yield
+    finally:
+        steps, _local.steps = _local.steps, None
+        end = time.perf_counter()
+        totals = report["weasyprint"].setdefault(template_name, {})
+        for (started, step), (finished, _) in zip(steps, steps[1:] + [(end, None)]):
+            totals[step] = totals.get(step, 0.0) + finished - started
+
+
+# samples the stack of one thread so the profile can be drawn as a flamegraph
+class StackSampler(threading.Thread):
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def _report_dir(order_id):
+    name = "".join(c if c.isalnum() or c in "-_" else "_" for c in str(order_id))
+    return os.path.join(PROFILE_REPORTS_DIR, name or "unknown")
+
+
+def _save(order_id, name, profiler, sampler, report):
+    directory = _report_dir(order_id)
+    os.makedirs(directory, exist_ok=True)
+    prefix = os.path.join(directory, "{}-{}-{}".format(time.strftime("%Y%m%dT%H%M%S"), name, os.getpid()))
+
+    profiler.dump_stats(prefix + ".pstats")
+    with open(prefix + ".collapsed", "w") as f:
+        for stack, count in sampler.stacks.most_common():
+            f.write("{} {}\n".format(stack, count))
+    with open(prefix + ".json", "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info("Saved {} profile of order {} to {}.*".format(name, order_id, prefix))
+
+
+# profiles the block with cProfile and a stack sampler and saves the reports of the order
+@contextmanager
+def profiled(order_id, name):
+    _install_step_handler()
+    report = {"order_id": str(order_id), "name": name, "pid": os.getpid(), "weasyprint": {}}
+    profiler = cProfile.Profile()
+    sampler = StackSampler(threading.get_ident())
+    _local.report = report
+    sampler.start()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        yield report
+    finally:
+        profiler.disable()
+        report["wall_seconds"] = time.perf_counter() - start
+        sampler.stop()
+        report["samples"] = sum(sampler.stacks.values())
+        _local.report = None
+        try:
+            _save(order_id, name, profiler, sampler, report)
+        except OSError as e:
+            logging.error("Error saving profile of order {} {}".format(order_id, e))
@@ -0,0 +1,134 @@
+import os
+import logging
+import threading
+import assets
+import metrics
+import font_bundle
+import profiling
+import template_env
+from page_cache import page_cache, combination_key, stitch_pages
+from weasyprint import HTML, CSS
+from weasyprint.text.fonts import FontConfiguration
+
+CARDS_CSS_PATH = "./css/cards.css"
+INSERTS_CSS_PATH = "./css/inserts.css"
+
+INSERTS_PAGES_TWO_ISSUES = '''
+    @page:nth(1) {
+        size: 576px 384px;
+        margin: 0;
+    }
+
+    @page:nth(2) {
+        size: 576px 384px;
+        margin: 0;
+    }
+
+    @page:nth(3) {
+        size: 528px 816px;
+        margin: 0;
+    }'''
+
+INSERTS_PAGES_ONE_ISSUE = '''
+    @page:nth(1) {
+        size: 576px 384px;
+        margin: 0;
+    }
+
+    @page:nth(2) {
+        size: 528px 816px;
+        margin: 0;
+    }'''
+
+_local = threading.local()
+
+
+# the stylesheet with its fonts swapped for the subset ones when they were built
+def _stylesheet(path, font_config):
+    source = font_bundle.stylesheet_source(path)
+    if source is None:
+        return CSS(filename=path, font_config=font_config)
+    return CSS(string=source, base_url=os.path.abspath(path), font_config=font_config)
+
+
+# holds everything a render can share with the next one: the parsed stylesheets, the fonts
+# registered from their @font-face rules, the processed images and the decoded images
+class RenderContext:
+
+    def __init__(self):
+        logging.info("Creating render context")
+        self.font_config = FontConfiguration()
+        self.image_cache = {}
+        assets.get_assets()
+        cards = _stylesheet(CARDS_CSS_PATH, self.font_config)
+        self.stylesheets = {
+            "cards": cards,
+            "cards_static": cards,
+            "cards_personalized": cards,
+            "inserts": _stylesheet(INSERTS_CSS_PATH, self.font_config),
+        }
+        self.inserts_pages = {
+            1: CSS(string=INSERTS_PAGES_ONE_ISSUE, font_config=self.font_config),
+            2: CSS(string=INSERTS_PAGES_TWO_ISSUES, font_config=self.font_config),
+        }
+
+    def stylesheets_for(self, template_name, template_data):
+        stylesheets = [self.stylesheets[template_name]]
+        if template_name == "inserts":
+            issues = 2 if len(template_data.get("issues")) > 1 else 1
+            stylesheets.append(self.inserts_pages[issues])
+        return stylesheets
+
+    def write_pdf(self, html_string, base_url, template_name, template_data):
+        with profiling.weasyprint_render(template_name):
+            html = HTML(string=html_string, base_url=base_url, url_fetcher=assets.url_fetcher)
+            with metrics.stage("layout"):
+                document = html.render(stylesheets=self.stylesheets_for(template_name, template_data),
+                                       font_config=self.font_config,
+                                       image_cache=self.image_cache)
+            with metrics.stage("write_pdf"):
+                return document.write_pdf()
+
+
+# returns the render context of the current worker, creating it on first use
+def get_render_context():
+    context = getattr(_local, "context", None)
+    if context is None:
+        context = _local.context = RenderContext()
+    return context
+
+
+def render_html_string(template_name, template_data):
+    with metrics.stage("template_render"):
+        return template_env.get_template(template_name).render(template_data)
+
+
+# the templates reference ../../images and ../../css relative to temp/<uuid>/<template>.html,
+# so in-memory renders use a base url at the same depth to keep those paths resolving
+def render_base_url(template_name):
+    return os.path.join(os.path.abspath("temp"), "render", "{}.html".format(template_name))
+
+
+# renders the template and the pdf without touching the filesystem and returns the pdf bytes
+def gen_pdf_bytes(template_name, template_data):
+    context = get_render_context()
+    # the stylesheet is already parsed in the render context, so the template skips its <link>
+    html_string = render_html_string(template_name, dict(template_data, preparsed_stylesheets=True))
+    return context.write_pdf(html_string, render_base_url(template_name), template_name, template_data)
+
+
+# renders only the personalized cards pages and stitches in the static pages of the order's
+# product combination, rendering those once per combination
+def gen_cards_pdf_bytes(template_data):
+    key = template_data.get('combination_key') or combination_key(template_data['issues'])
+    static_pdf = page_cache.get(key)
+    if static_pdf is None:
+        logging.info("Rendering static cards pages for {}".format(key))
+        static_pdf = gen_pdf_bytes("cards_static", template_data)
+        page_cache.put(key, static_pdf)
+
+    personalized_pdf = gen_pdf_bytes("cards_personalized", template_data)
+    with metrics.stage("stitch"):
+        pdf, pages = stitch_pages(personalized_pdf, static_pdf)
+    metrics.observe_pdf(pdf, pages)
+    return pdf
@@ -0,0 +1,348 @@
+import os
+import sys
+import time
+import types
+import logging
+import threading
+import multiprocessing
+import multiprocessing.context
+import multiprocessing.pool
+from contextlib import contextmanager
+import assets
+import metrics
+import font_bundle
+import profiling
+import template_env
+
+# number of render processes, 0 renders in the calling thread
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", os.cpu_count() or 1))
+# forkserver keeps the render processes from inheriting the web process threads and locks
+RENDER_START_METHOD = os.environ.get("RENDER_START_METHOD", "forkserver")
+# seconds to wait for a render before giving up on it
+RENDER_TIMEOUT = float(os.environ.get("RENDER_TIMEOUT", "300"))
+# renders running at the same time, each one holds a whole cards document in memory
+RENDER_CONCURRENCY = int(os.environ.get("RENDER_CONCURRENCY", RENDER_WORKERS or 1))
+# renders requested by a web request that may wait for a slot, past that the request gets a 503.
+# the order workers and batch runs always wait, their own thread counts bound them
+RENDER_QUEUE_SIZE = int(os.environ.get("RENDER_QUEUE_SIZE", "8"))
+# seconds a request turned away is told to wait before retrying
+RENDER_RETRY_AFTER = int(os.environ.get("RENDER_RETRY_AFTER", "30"))
+# a render worker is replaced after this many renders, 0 keeps it forever
+RENDER_MAX_TASKS = int(os.environ.get("RENDER_MAX_TASKS", "200"))
+# the render workers are replaced once one of them is bigger than this after a render, 0 for no limit
+RENDER_MAX_RSS_MB = int(os.environ.get("RENDER_MAX_RSS_MB", "1024"))
+
+_pool = None
+_warmup_template_data = None
+# pool => renders given to it that haven't come back, a replaced pool is closed once it has none
+_in_flight = {}
+# pools terminated because a render ran past the timeout, the renders still waiting on them give up
+_terminated = set()
+_lock = threading.Lock()
+
+
+class RenderQueueFull(Exception):
+
+    def __init__(self, retry_after=RENDER_RETRY_AFTER):
+        super().__init__("Too many renders waiting, retry in {}s".format(retry_after))
+        self.retry_after = retry_after
+
+
+# limits the renders running at once, renders past the limit wait for a slot in arrival order
+class RenderScheduler:
+
+    def __init__(self, concurrency=RENDER_CONCURRENCY, queue_size=RENDER_QUEUE_SIZE):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.running = 0
+        self.waiting = 0
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        # whether the current thread holds a place reserved by admission()
+        self._local = threading.local()
+        metrics.RENDER_CONCURRENCY_LIMIT.set(concurrency)
+        metrics.RENDER_QUEUE_LIMIT.set(queue_size)
+
+    # takes a place in the wait queue, raises RenderQueueFull when there is none. the check and the
+    # reservation happen under one lock, so requests arriving together can't all take the last place
+    def reserve(self):
+        with self._lock:
+            if self.running + self.waiting >= self.concurrency + self.queue_size:
+                metrics.RENDERS_REJECTED.inc()
+                raise RenderQueueFull()
+            self.waiting += 1
+        metrics.RENDERS_WAITING.inc()
+
+    def release(self):
+        with self._lock:
+            self.waiting -= 1
+        metrics.RENDERS_WAITING.dec()
+
+    # reserves a place for the renders the current thread asks for in the block, the first one
+    # waits for its slot in that place
+    @contextmanager
+    def admission(self):
+        self.reserve()
+        self._local.reserved = True
+        try:
+            yield
+        finally:
+            if self._local.reserved:
+                self._local.reserved = False
+                self.release()
+
+    @contextmanager
+    def slot(self):
+        if getattr(self._local, "reserved", False):
+            self._local.reserved = False
+        else:
+            with self._lock:
+                self.waiting += 1
+            metrics.RENDERS_WAITING.inc()
+        try:
+            self._slots.acquire()
+        finally:
+            self.release()
+        with self._lock:
+            self.running += 1
+        metrics.RENDERS_IN_FLIGHT.inc()
+        try:
+            yield
+        finally:
+            metrics.RENDERS_IN_FLIGHT.dec()
+            with self._lock:
+                self.running -= 1
+            self._slots.release()
+
+
+scheduler = RenderScheduler()
+metrics.RENDER_WORKER_RSS_LIMIT.set(RENDER_MAX_RSS_MB * 1024 * 1024)
+metrics.RENDER_WORKER_MAX_TASKS.set(RENDER_MAX_TASKS)
+
+
+# resident memory of this process
+def _rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        # the peak instead of the current size where there is no /proc, in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# runs once in every render process so the first order it gets doesn't pay for the setup. only
+# the render modules are imported here, the application module would start a queue, a ledger and
+# load the catalog in every render process
+def _warm_worker(warmup_template_data=None):
+    from render_context import get_render_context, gen_cards_pdf_bytes
+
+    for template_name in ("cards_static", "cards_personalized", "cards", "inserts"):
+        template_env.get_template(template_name)
+    get_render_context()
+    if warmup_template_data is not None:
+        # the first render initializes fontconfig, pango and cairo and loads the fonts and images
+        try:
+            gen_cards_pdf_bytes(warmup_template_data)
+        except Exception:
+            logging.exception("Error rendering the warm-up order in render worker {}".format(os.getpid()))
+    logging.info("Render worker {} ready".format(os.getpid()))
+
+
+# runs in a render process, the metrics it records and its size are sent back with the pdf
+def _render_cards(template_data, profile_id=None):
+    from render_context import gen_cards_pdf_bytes
+    with metrics.collect_observations() as observations:
+        if profile_id is None:
+            pdf = gen_cards_pdf_bytes(template_data)
+        else:
+            with profiling.profiled(profile_id, "render"):
+                pdf = gen_cards_pdf_bytes(template_data)
+    return pdf, observations, _rss()
+
+
+# modules the forkserver imports before it forks the render processes, instead of the __main__
+# module it imports by default
+FORKSERVER_PRELOAD = ["render_pool", "render_context"]
+
+_main_lock = threading.Lock()
+
+
+def _context():
+    context = multiprocessing.get_context(RENDER_START_METHOD)
+    if RENDER_START_METHOD == "forkserver":
+        context.set_forkserver_preload(FORKSERVER_PRELOAD)
+    return context
+
+
+# forkserver and spawn processes import the __main__ module of the process that started them
+# before running anything. the entry points (application.py, batch.py, print_batch.py) all import
+# application, which opens the job queue and the ledger and loads the catalog, so the render
+# processes are started with an empty __main__ in its place
+@contextmanager
+def _main_hidden():
+    with _main_lock:
+        main = sys.modules["__main__"]
+        sys.modules["__main__"] = types.ModuleType("__main__")
+        try:
+            yield
+        finally:
+            sys.modules["__main__"] = main
+
+
+class _MainHiddenProcess:
+
+    def start(self):
+        with _main_hidden():
+            super().start()
+
+
+class _ForkServerProcess(_MainHiddenProcess, multiprocessing.context.ForkServerProcess):
+    pass
+
+
+class _SpawnProcess(_MainHiddenProcess, multiprocessing.context.SpawnProcess):
+    pass
+
+
+class _RenderPool(multiprocessing.pool.Pool):
+
+    # also makes the processes that replace the workers after RENDER_MAX_TASKS renders
+    @staticmethod
+    def Process(ctx, *args, **kwds):
+        process_class = {"forkserver": _ForkServerProcess, "spawn": _SpawnProcess}.get(ctx.get_start_method(),
+                                                                                       ctx.Process)
+        return process_class(*args, **kwds)
+
+
+# the template data of the order the render processes render when they start, pools created
+# later to replace the workers use it too
+def start_render_pool(workers=RENDER_WORKERS, warmup_template_data=None):
+    global _pool, _warmup_template_data
+    with _lock:
+        if warmup_template_data is not None:
+            _warmup_template_data = warmup_template_data
+        assets.prepare_assets()
+        font_bundle.prepare_fonts()
+        if _pool is None and workers > 0:
+            logging.info("Starting render pool with {} workers".format(workers))
+            _pool = _RenderPool(processes=workers, initializer=_warm_worker, initargs=(_warmup_template_data,),
+                                maxtasksperchild=RENDER_MAX_TASKS or None, context=_context())
+        return _pool
+
+
+def stop_render_pool():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.close()
+            _pool.join()
+            _in_flight.pop(_pool, None)
+            _pool = None
+
+
+# the current pool with one more render counted against it, None when there are no render processes
+def _checkout_pool():
+    while True:
+        pool = start_render_pool()
+        if pool is None:
+            return None
+        with _lock:
+            # otherwise it was replaced since, and is closing
+            if pool is _pool:
+                _in_flight[pool] = _in_flight.get(pool, 0) + 1
+                return pool
+
+
+def _checkin_pool(pool):
+    with _lock:
+        _in_flight[pool] -= 1
+        retire = pool is not _pool and _in_flight[pool] == 0
+        if retire:
+            del _in_flight[pool]
+    if retire:
+        _retire_pool(pool)
+
+
+# stops handing out the pool, it's closed once the renders it was given came back
+def _replace_pool(pool):
+    global _pool
+    with _lock:
+        if _pool is not pool:
+            # already replaced after another render of the same pool
+            return False
+        _pool = None
+        retire = not _in_flight.get(pool)
+        if retire:
+            _in_flight.pop(pool, None)
+    if retire:
+        _retire_pool(pool)
+    return True
+
+
+def _retire_pool(pool):
+    with _lock:
+        terminated = pool in _terminated
+        _terminated.discard(pool)
+    if terminated:
+        return
+    pool.close()
+    threading.Thread(target=pool.join, name="render-pool-retire", daemon=True).start()
+
+
+# a pool worker can't be told to exit once it's idle, so when one of them grew past the memory
+# limit the whole pool is replaced. the old workers finish the renders they were given and exit
+def _recycle_pool(pool, rss):
+    if not _replace_pool(pool):
+        return
+    logging.warning("Render worker uses {} MB, over the {} MB limit, replacing the render workers".format(
+        rss // (1024 * 1024), RENDER_MAX_RSS_MB))
+    metrics.RENDER_WORKERS_RECYCLED.inc()
+
+
+# a render that ran past the timeout still holds its worker, so the pool is killed to keep the
+# renders running within the concurrency limit. the other renders of that pool fail with it
+def _terminate_pool(pool):
+    with _lock:
+        if pool in _terminated:
+            return
+        _terminated.add(pool)
+    _replace_pool(pool)
+    logging.error("Render ran past {}s, terminating the render workers".format(RENDER_TIMEOUT))
+    metrics.RENDER_WORKERS_RECYCLED.inc()
+    pool.terminate()
+
+
+# waits for the render, giving up once the timeout passed or its pool was terminated
+def _wait(pool, result):
+    deadline = time.monotonic() + RENDER_TIMEOUT
+    while not result.ready():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            _terminate_pool(pool)
+            raise multiprocessing.TimeoutError("Render ran past {}s".format(RENDER_TIMEOUT))
+        if pool in _terminated:
+            raise multiprocessing.TimeoutError("Render workers terminated after another render timed out")
+        result.wait(min(remaining, 1))
+    return result.get()
+
+
+# renders the cards pdf of an order in one of the render processes and returns its bytes,
+# with a profile_id the render process saves a profile of the render under that id
+def render_cards(template_data, profile_id=None):
+    with scheduler.slot():
+        pool = _checkout_pool()
+        if pool is None:
+            # rendered on the calling thread, so a profile of the pipeline already covers it
+            from render_context import gen_cards_pdf_bytes
+            return gen_cards_pdf_bytes(template_data)
+
+        try:
+            pdf, observations, rss = _wait(pool, pool.apply_async(_render_cards, (template_data, profile_id)))
+        finally:
+            _checkin_pool(pool)
+    metrics.replay(observations)
+    metrics.RENDER_WORKER_RSS.observe(rss)
+    if RENDER_MAX_RSS_MB and rss > RENDER_MAX_RSS_MB * 1024 * 1024:
+        _recycle_pool(pool, rss)
+    return pdf
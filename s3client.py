@@ -1,47 +1,139 @@
+import io
+import os
 import logging
-import boto3
-from botocore.exceptions import ClientError
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-BUCKET_NAME = "zippzpdfs"
-s3 = boto3.resource('s3')
+BUCKET_NAME = os.environ.get("S3_BUCKET", "zippzpdfs")
+# point this at a local stand-in (moto server, MinIO) to run without AWS
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL") or None
+PRESIGNED_URL_EXPIRES = 1600000
 
+# uploads of one order run in parallel, large files are split into concurrent multipart parts
+UPLOAD_WORKERS = int(os.environ.get("S3_UPLOAD_WORKERS", "8"))
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+MULTIPART_CONCURRENCY = 8
 
+_lock = threading.Lock()
+_client = None
+_executor = None
+_transfer_config = None
+_pid = None
+
+
+# one client and upload pool per process, recreated after a fork. boto3 is imported here so
+# importing this module doesn't pay for it
+def _init():
+    global _client, _executor, _transfer_config, _pid
+    with _lock:
+        if _pid != os.getpid():
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config
+
+            _transfer_config = TransferConfig(
+                multipart_threshold=MULTIPART_CHUNKSIZE,
+                multipart_chunksize=MULTIPART_CHUNKSIZE,
+                max_concurrency=MULTIPART_CONCURRENCY,
+                use_threads=True
+            )
+            client_config = Config(
+                max_pool_connections=UPLOAD_WORKERS * _transfer_config.max_request_concurrency,
+                retries={"max_attempts": 5, "mode": "standard"}
+            )
+            session = boto3.session.Session()
+            _client = session.client('s3', endpoint_url=S3_ENDPOINT_URL, config=client_config)
+            _executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="s3-upload")
+            _pid = os.getpid()
+
+
+def get_client():
+    if _pid != os.getpid():
+        _init()
+    return _client
+
+
+def _get_executor():
+    if _pid != os.getpid():
+        _init()
+    return _executor
+
+
+# signs every key locally in one pass, returns a dict of key => url
+def generate_presigned_urls_for_keys(keys):
+    s3 = get_client()
+    return {
+        key: s3.generate_presigned_url('get_object',
+                                       Params={'Bucket': BUCKET_NAME, 'Key': key},
+                                       ExpiresIn=PRESIGNED_URL_EXPIRES)
+        for key in keys
+    }
+
+
+# (inserts url, cards url) of the order, (None, None) when they can't be signed
 def generate_presigned_urls(uuid):
+    from botocore.exceptions import ClientError
     try:
         logging.info("Start generating signed urls for uuid {}".format(uuid));
-        s3 = boto3.client('s3')
-
-        insert_file_url = s3.generate_presigned_url('get_object',
-                                                    Params={'Bucket': BUCKET_NAME,
-                                                            'Key': "{}/inserts.pdf".format(uuid)},
-                                                    ExpiresIn=1600000)
-        cards_file_url = s3.generate_presigned_url('get_object',
-                                                    Params={'Bucket': BUCKET_NAME,
-                                                            'Key': "{}/cards.pdf".format(uuid)},
-                                                    ExpiresIn=1600000)
+        inserts_key = "{}/inserts.pdf".format(uuid)
+        cards_key = "{}/cards.pdf".format(uuid)
+        urls = generate_presigned_urls_for_keys([inserts_key, cards_key])
         logging.info("Finished generating signed urls for uuid {}".format(uuid));
-        return insert_file_url, cards_file_url
+        return urls[inserts_key], urls[cards_key]
     except ClientError as e:
         logging.error("Error generating presigned url {}".format(e));
-        return None
+        return None, None
 
 
-def upload_file_to_aws(file_path,folder):
-   file_name = file_path.split('/')[-1]
-   logging.info("Uploading file with name {} started".format(file_path))
-   try:
-        s3.Bucket('zippzpdfs').upload_file(file_path, '{}/{}'.format(folder,file_name))
+def upload_file_to_aws(file_path, folder):
+    if not file_path or not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+        logging.info("Skipping empty upload {}".format(file_path))
+        return False
+
+    file_name = file_path.split('/')[-1]
+    logging.info("Uploading file with name {} started".format(file_path))
+    try:
+        get_client().upload_file(file_path, BUCKET_NAME, '{}/{}'.format(folder, file_name),
+                                 Config=_transfer_config)
+        return True
+    except Exception as e:
+        logging.error("Error uploading file with name {} {}".format(file_path, e))
+        return False
 
-   except Exception as e:
-       logging.error("Error uploading file with name {}".format(file_path))
 
+def upload_files_to_aws(files_list, folder):
+    futures = {file_path: _get_executor().submit(upload_file_to_aws, file_path, folder)
+               for file_path in files_list}
+    uploaded = []
+    for file_path, future in futures.items():
+        if future.result():
+            uploaded.append(file_path)
+            logging.info("Uploading file with name {} finished".format(file_path))
+    return uploaded
 
 
-def upload_files_to_aws(files_list,folder):
-    for file_path in files_list:
-        upload_file_to_aws(file_path,folder)
-        logging.info("Uploading file with name {} finished".format(file_path))
+def upload_bytes_to_aws(data, file_name, folder):
+    if not data:
+        logging.info("Skipping empty upload {}".format(file_name))
+        return False
 
+    logging.info("Uploading file with name {} started".format(file_name))
+    try:
+        get_client().upload_fileobj(io.BytesIO(data), BUCKET_NAME, '{}/{}'.format(folder, file_name),
+                                    Config=_transfer_config)
+        return True
+    except Exception as e:
+        logging.error("Error uploading file with name {} {}".format(file_name, e))
+        return False
 
 
-#generate_presigned_url()
\ No newline at end of file
+# uploads in-memory pdfs, files is a dict of file name => pdf bytes
+def upload_pdfs_to_aws(files, folder):
+    futures = {file_name: _get_executor().submit(upload_bytes_to_aws, data, file_name, folder)
+               for file_name, data in files.items()}
+    uploaded = []
+    for file_name, future in futures.items():
+        if future.result():
+            uploaded.append(file_name)
+            logging.info("Uploading file with name {} finished".format(file_name))
+    return uploaded
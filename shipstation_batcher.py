@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import Future
+from http_clients import shipstation, SHIPSTATION_API_URL
+
+CREATE_ORDERS_URL = SHIPSTATION_API_URL + "/orders/createorders"
+
+# an order waits at most BATCH_WINDOW seconds for others to join its batch,
+# shipstation accepts up to 100 orders per createorders call
+BATCH_WINDOW = float(os.environ.get("SHIPSTATION_BATCH_WINDOW", "2"))
+BATCH_SIZE = int(os.environ.get("SHIPSTATION_BATCH_SIZE", "100"))
+
+
+class ShipStationError(Exception):
+    pass
+
+
+# collects orders and creates them in shipstation with one createorders call per batch,
+# every submitted order gets a future resolved with its own result
+class ShipStationBatcher:
+
+    def __init__(self, ledger=None, window=BATCH_WINDOW, size=BATCH_SIZE, url=CREATE_ORDERS_URL, client=shipstation):
+        self.ledger = ledger
+        self.window = window
+        self.size = size
+        self.url = url
+        self.client = client
+        self._pending = []
+        self._first_at = None
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def submit(self, order):
+        future = Future()
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="shipstation-batcher", daemon=True)
+                self._thread.start()
+            if not self._pending:
+                self._first_at = time.monotonic()
+            self._pending.append((order, future))
+            self._condition.notify()
+        return future
+
+    def _next_batch(self):
+        with self._condition:
+            while True:
+                if self._pending:
+                    wait = self._first_at + self.window - time.monotonic()
+                    if len(self._pending) >= self.size or wait <= 0:
+                        batch = self._pending[:self.size]
+                        self._pending = self._pending[self.size:]
+                        self._first_at = time.monotonic()
+                        return batch
+                    self._condition.wait(wait)
+                else:
+                    self._condition.wait()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.send(batch)
+            except Exception as e:
+                logging.exception("Error sending {} orders to shipstation".format(len(batch)))
+                for order, future in batch:
+                    if not future.done():
+                        self._record(order, None, str(e))
+                        future.set_exception(e)
+
+    def send(self, batch):
+        logging.info("Sending {} orders to shipstation".format(len(batch)))
+        response = self.client.post(self.url, data=json.dumps([order for order, _ in batch]))
+        if response.status_code != 200:
+            raise ShipStationError("createorders answered {} {}".format(response.status_code, response.text))
+
+        results = {str(result.get("orderKey")): result for result in response.json().get("results", [])}
+        for order, future in batch:
+            result = results.get(str(order["orderKey"]))
+            if result is None:
+                error = "no result returned for order {}".format(order["orderKey"])
+            elif not result.get("success"):
+                error = result.get("errorMessage") or "order was not created"
+            else:
+                error = None
+
+            self._record(order, result, error)
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(ShipStationError(error))
+
+    def _record(self, order, result, error):
+        if self.ledger is None:
+            return
+        try:
+            self.ledger.upsert(order["orderKey"],
+                               shipstation_status="failed" if error else "created",
+                               shipstation_order_id=result.get("orderId") if result else None,
+                               shipstation_response=error or json.dumps(result))
+        except Exception as e:
+            logging.error("Error recording shipstation result for order {} {}".format(order["orderKey"], e))
@@ -0,0 +1,133 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+
+SASS_DIR = "./sass"
+CSS_DIR = "./css"
+# hash of the sass sources the css was last compiled from
+SASS_STAMP_PATH = os.environ.get("SASS_STAMP_PATH", "./build/sass.sha256")
+# render the warm-up order in every render process before it takes real orders
+WARMUP_RENDER = os.environ.get("WARMUP_RENDER", "1") == "1"
+
+# a two issue order, so the warm-up renders the static and the personalized pages of the cards
+WARMUP_ORDER = {
+    "id": "warmup",
+    "customer_id": 0,
+    "order_key": "warmup",
+    "date_created": "2021-01-01T00:00:00",
+    "date_modified": "2021-01-01T00:00:00",
+    "billing": {
+        "first_name": "Warm",
+        "last_name": "Up",
+        "address_1": "1 Main St",
+        "address_2": "",
+        "city": "San Francisco",
+        "state": "CA",
+        "postcode": "94107",
+        "country": "US",
+    },
+    "line_items": [
+        {"id": 1, "name": "Trial 4-Pack", "sku": "TRIAL-4", "quantity": 1, "subtotal": "0.00", "product_id": 1},
+        {"id": 2, "name": "CalmZ-30"},
+        {"id": 3, "name": "CalmZ-32"},
+        {"id": 4, "name": "SleepZ-10"},
+        {"id": 5, "name": "SleepZ-12"},
+    ],
+}
+
+
+def _sources_sha256(directory):
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, directory).encode("utf-8"))
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+# compiles sass/ into css/ when the sources changed since the last compile, returns whether it did
+def compile_scss_if_changed(sass_dir=SASS_DIR, css_dir=CSS_DIR, stamp_path=SASS_STAMP_PATH):
+    digest = _sources_sha256(sass_dir)
+    try:
+        with open(stamp_path) as f:
+            if f.read().strip() == digest:
+                return False
+    except OSError:
+        pass
+
+    import sass
+    logging.info("Compiling {} into {}".format(sass_dir, css_dir))
+    for root, _, files in os.walk(sass_dir):
+        for name in files:
+            if not name.endswith(".scss") or name.startswith("_"):
+                continue
+            path = os.path.join(root, name)
+            output_path = os.path.join(css_dir, os.path.relpath(path, sass_dir))[:-len(".scss")] + ".css"
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            # written to a temporary file first so a render process never reads half a stylesheet
+            tmp_path = "{}.{}.tmp".format(output_path, os.getpid())
+            with open(tmp_path, "w") as f:
+                f.write(sass.compile(filename=path))
+            os.replace(tmp_path, output_path)
+
+    os.makedirs(os.path.dirname(stamp_path), exist_ok=True)
+    with open(stamp_path, "w") as f:
+        f.write(digest)
+    return True
+
+
+# runs the startup steps in the background and keeps their timings for the readiness endpoint
+class WarmUp:
+
+    def __init__(self):
+        self.started_at = None
+        self.finished_at = None
+        self.steps = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, target):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.started_at = time.time()
+            self._thread = threading.Thread(target=self._run, args=(target,), name="warm-up", daemon=True)
+            self._thread.start()
+
+    def _run(self, target):
+        try:
+            target()
+        except Exception as e:
+            logging.exception("Error warming up")
+            self.errors["warm_up"] = "{}: {}".format(type(e).__name__, e)
+        self.finished_at = time.time()
+        logging.info("Warm-up finished in {:.2f}s {}".format(self.finished_at - self.started_at, self.steps))
+
+    # runs one step, a failing step is recorded and the next steps still run
+    def step(self, name, function):
+        start = time.time()
+        try:
+            function()
+        except Exception as e:
+            logging.exception("Error in warm-up step {}".format(name))
+            self.errors[name] = "{}: {}".format(type(e).__name__, e)
+        self.steps[name] = round(time.time() - start, 4)
+
+    @property
+    def ready(self):
+        return self.finished_at is not None and not self.errors
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "started": self.started_at is not None,
+            "finished": self.finished_at is not None,
+            "steps": dict(self.steps),
+            "errors": dict(self.errors),
+        }
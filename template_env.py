@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+import threading
+import jinja2
+from jinja2 import Environment, FileSystemLoader, ModuleLoader, FileSystemBytecodeCache, select_autoescape
+
+TEMPLATES_DIR = "templates"
+# the templates compiled to python modules, one directory per version of the templates
+COMPILED_TEMPLATES_DIR = os.environ.get("COMPILED_TEMPLATES_DIR", "./build/templates")
+# bytecode of the templates parsed from templates/ when there are no compiled modules for them
+BYTECODE_CACHE_DIR = os.environ.get("TEMPLATES_BYTECODE_CACHE_DIR", "./build/jinja_cache")
+# check templates/ for changes on every render, for working on the templates only
+TEMPLATES_AUTO_RELOAD = os.environ.get("TEMPLATES_AUTO_RELOAD", "0") == "1"
+# a compile interrupted this long ago is left over by a dead process
+STALE_TMP_SECONDS = 3600
+
+_lock = threading.Lock()
+_env = None
+# directory of the compiled templates the environment loads, None when it parses templates/
+_env_compiled_dir = None
+# template objects resolved once per environment, the templates don't change while it runs
+_templates = {}
+
+
+# hash of the templates and the jinja version, compiled modules only work with the version that made them
+def _templates_sha256():
+    digest = hashlib.sha256(jinja2.__version__.encode("utf-8"))
+    for root, dirs, files in os.walk(TEMPLATES_DIR):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, TEMPLATES_DIR).encode("utf-8"))
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _compiled_dir(sha256):
+    return os.path.join(COMPILED_TEMPLATES_DIR, sha256[:16])
+
+
+def _environment(loader, bytecode_cache=None):
+    return Environment(
+        loader=loader,
+        autoescape=select_autoescape(['html', 'xml']),
+        auto_reload=TEMPLATES_AUTO_RELOAD,
+        bytecode_cache=bytecode_cache
+    )
+
+
+# removes the compiled templates of earlier versions of templates/ and compiles that a dead
+# process left half done
+def _prune_compiled(keep):
+    try:
+        names = os.listdir(COMPILED_TEMPLATES_DIR)
+    except FileNotFoundError:
+        return
+    stale = time.time() - STALE_TMP_SECONDS
+    for name in names:
+        path = os.path.join(COMPILED_TEMPLATES_DIR, name)
+        if path == keep or not os.path.isdir(path):
+            continue
+        if name.endswith(".tmp") and os.path.getmtime(path) > stale:
+            # another process is compiling right now
+            continue
+        logging.info("Removing old compiled templates {}".format(path))
+        shutil.rmtree(path, ignore_errors=True)
+
+
+# compiles every template to a python module unless the current templates already were,
+# returns whether it compiled them. the environment is switched to the compiled modules
+def compile_templates_if_changed():
+    target = _compiled_dir(_templates_sha256())
+    compiled = not os.path.isdir(target)
+    if compiled:
+        logging.info("Compiling templates into {}".format(target))
+        tmp_path = "{}.{}.tmp".format(target, os.getpid())
+        _environment(FileSystemLoader(TEMPLATES_DIR)).compile_templates(tmp_path, zip=None)
+        try:
+            os.rename(tmp_path, target)
+        except OSError:
+            # another process compiled the same templates first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    _prune_compiled(target)
+    with _lock:
+        if _env is not None and _env_compiled_dir != target and not TEMPLATES_AUTO_RELOAD:
+            _reset_environment()
+    return compiled
+
+
+# loads the compiled templates when they match templates/, otherwise parses templates/ through
+# the bytecode cache. returns the environment and the directory of the compiled templates
+def create_environment():
+    if not TEMPLATES_AUTO_RELOAD:
+        compiled = _compiled_dir(_templates_sha256())
+        if os.path.isdir(compiled):
+            return _environment(ModuleLoader(compiled)), compiled
+    os.makedirs(BYTECODE_CACHE_DIR, exist_ok=True)
+    return (_environment(FileSystemLoader(searchpath=TEMPLATES_DIR), FileSystemBytecodeCache(BYTECODE_CACHE_DIR)),
+            None)
+
+
+def _reset_environment():
+    global _env, _env_compiled_dir
+    _env = None
+    _env_compiled_dir = None
+    _templates.clear()
+
+
+def get_environment():
+    global _env, _env_compiled_dir
+    with _lock:
+        if _env is None:
+            _env, _env_compiled_dir = create_environment()
+        return _env
+
+
+def get_template(template_name):
+    env = get_environment()
+    if TEMPLATES_AUTO_RELOAD:
+        return env.get_template("{}.html".format(template_name))
+    template = _templates.get(template_name)
+    if template is None:
+        template = _templates[template_name] = env.get_template("{}.html".format(template_name))
+    return template
+
+
+# compiles the templates ahead of time, for building the image
+def main():
+    global COMPILED_TEMPLATES_DIR
+    parser = argparse.ArgumentParser(description="Compile the jinja templates to python modules")
+    parser.add_argument("--output", default=COMPILED_TEMPLATES_DIR)
+    args = parser.parse_args()
+
+    COMPILED_TEMPLATES_DIR = args.output
+    logging.basicConfig(level=logging.INFO)
+    compiled = compile_templates_if_changed()
+    print("{} {}".format("compiled" if compiled else "up to date", _compiled_dir(_templates_sha256())))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
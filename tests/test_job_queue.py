@@ -0,0 +1,115 @@
+import pytest
+import job_queue
+from job_queue import JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.db"))
+
+
+def _deliver(queue, date_modified, fingerprint, order_id=1):
+    return queue.enqueue_once(order_id, {"id": order_id, "date_modified": date_modified}, date_modified, fingerprint)
+
+
+def _finish(queue, status=job_queue.PUSHED):
+    job = queue.claim()
+    job.set_status(status)
+    return job
+
+
+def test_first_delivery_is_queued(queue):
+    status, created = _deliver(queue, "2021-05-05T10:00:00", "v1")
+    assert created
+    assert status["status"] == job_queue.QUEUED
+
+
+def test_exact_redelivery_reuses_the_job(queue):
+    first, _ = _deliver(queue, "2021-05-05T10:00:00", "v1")
+    _finish(queue)
+    status, created = _deliver(queue, "2021-05-05T10:00:00", "v1")
+    assert not created
+    assert status["job_id"] == first["job_id"]
+    assert status["status"] == job_queue.PUSHED
+
+
+def test_redelivery_while_in_flight_reuses_the_job(queue):
+    first, _ = _deliver(queue, "2021-05-05T10:00:00", "v1")
+    queue.claim()
+    status, created = _deliver(queue, "2021-05-05T10:00:00", "v1")
+    assert not created
+    assert status["job_id"] == first["job_id"]
+    assert status["status"] == job_queue.RENDERING
+
+
+def test_change_of_an_unused_field_reuses_the_job(queue):
+    first, _ = _deliver(queue, "2021-05-05T10:00:00", "v1")
+    _finish(queue)
+    status, created = _deliver(queue, "2021-05-05T11:00:00", "v1")
+    assert not created
+    assert status["job_id"] == first["job_id"]
+
+
+def test_change_back_to_an_earlier_version_is_queued(queue):
+    _deliver(queue, "2021-05-05T10:00:00", "v1")
+    _finish(queue)
+    second, _ = _deliver(queue, "2021-05-05T11:00:00", "v2")
+    _finish(queue)
+    status, created = _deliver(queue, "2021-05-05T12:00:00", "v1")
+    assert created
+    assert status["job_id"] > second["job_id"]
+    assert queue.payload(1)["date_modified"] == "2021-05-05T12:00:00"
+
+
+def test_delivery_older_than_the_latest_job_is_ignored(queue):
+    _deliver(queue, "2021-05-05T10:00:00", "v1")
+    _finish(queue)
+    second, _ = _deliver(queue, "2021-05-05T11:00:00", "v2")
+    status, created = _deliver(queue, "2021-05-05T10:00:00", "v1")
+    assert not created
+    assert status["stale"]
+    assert status["job_id"] == second["job_id"]
+
+
+def test_failed_job_is_queued_again(queue):
+    first, _ = _deliver(queue, "2021-05-05T10:00:00", "v1")
+    _finish(queue, job_queue.FAILED)
+    status, created = _deliver(queue, "2021-05-05T10:00:00", "v1")
+    assert created
+    assert status["job_id"] != first["job_id"]
+
+
+def test_orders_are_deduplicated_separately(queue):
+    _deliver(queue, "2021-05-05T10:00:00", "v1", order_id=1)
+    status, created = _deliver(queue, "2021-05-05T10:00:00", "v1", order_id=2)
+    assert created
+
+
+def test_claim_of_a_live_process_is_kept(queue):
+    _deliver(queue, "2021-05-05T10:00:00", "v1")
+    queue.claim()
+    restarted = JobQueue(queue.path)
+    restarted.requeue_interrupted()
+    assert queue.status(1)["status"] == job_queue.RENDERING
+
+
+def test_claim_that_is_not_renewed_is_requeued(queue, monkeypatch):
+    _deliver(queue, "2021-05-05T10:00:00", "v1")
+    queue.claim()
+    # a process started again with the pid of the one that claimed the job
+    restarted = JobQueue(queue.path)
+    monkeypatch.setattr(job_queue, "JOB_LEASE_SECONDS", -1)
+    restarted.requeue_interrupted()
+    assert queue.status(1)["status"] == job_queue.QUEUED
+    assert restarted.claim().order_id == "1"
+
+
+def test_heartbeat_renews_the_claim(queue, monkeypatch):
+    _deliver(queue, "2021-05-05T10:00:00", "v1")
+    queue.claim()
+    monkeypatch.setattr(job_queue, "JOB_LEASE_SECONDS", 0.5)
+    time_now = job_queue.time.time
+    monkeypatch.setattr(job_queue.time, "time", lambda: time_now() + 10)
+    queue.heartbeat()
+    JobQueue(queue.path).requeue_interrupted()
+    assert queue.status(1)["status"] == job_queue.RENDERING
@@ -0,0 +1,30 @@
+from page_cache import PageCache
+
+
+def test_evicts_least_recently_used_pages_over_the_byte_limit():
+    cache = PageCache(max_bytes=100)
+    for key in "abc":
+        cache.put(key, b"x" * 40)
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    cache.put("d", b"x" * 40)
+    assert cache.get("c") is None
+    assert cache.get("b") is not None
+    assert cache.size == 80
+
+
+def test_replacing_an_entry_counts_its_new_size():
+    cache = PageCache(max_bytes=100)
+    cache.put("a", b"x" * 40)
+    cache.put("a", b"x" * 10)
+    assert cache.size == 10
+
+
+def test_keeps_an_entry_larger_than_the_limit():
+    cache = PageCache(max_bytes=100)
+    cache.put("a", b"x" * 40)
+    cache.put("b", b"x" * 200)
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    cache.clear()
+    assert cache.size == 0
@@ -0,0 +1,17 @@
+import pytest
+import profiling
+
+
+@pytest.fixture(autouse=True)
+def token(monkeypatch):
+    monkeypatch.setattr(profiling, "settings", lambda: {"token": "s3cret"})
+
+
+def test_matching_token_requests_a_profile():
+    assert profiling.requested({profiling.PROFILE_HEADER: "s3cret"})
+
+
+@pytest.mark.parametrize("value", [None, "", "wrong", "s3crét", "☃"])
+def test_other_values_do_not(value):
+    headers = {} if value is None else {profiling.PROFILE_HEADER: value}
+    assert not profiling.requested(headers)
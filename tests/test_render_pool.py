@@ -0,0 +1,46 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the entry points run as the main module and import application
+MAIN = '''
+import sys, json
+sys.path.append({repo!r})
+import application
+import render_pool
+
+WORKER_STATE = "[sorted(__import__('sys').modules), getattr(__import__('sys').modules['__main__'], '__file__', None)]"
+
+if __name__ == '__main__':
+    pool = render_pool._RenderPool(1, maxtasksperchild=1, context=render_pool._context())
+    # the second task runs in a worker that replaced the first one
+    for _ in range(2):
+        print(json.dumps(pool.apply(eval, (WORKER_STATE,))))
+    pool.close()
+    pool.join()
+'''
+
+
+@pytest.mark.parametrize("start_method", ["forkserver", "spawn"])
+def test_render_workers_do_not_import_the_main_module(tmp_path, start_method):
+    try:
+        import weasyprint  # noqa: F401
+    except (ImportError, OSError) as e:
+        pytest.skip("weasyprint can't be loaded: {}".format(e))
+    (tmp_path / "main.py").write_text(MAIN.format(repo=REPO))
+    # stands in for the application module, its import has side effects
+    (tmp_path / "application.py").write_text("open('application_imported', 'a').close()\n")
+    env = dict(os.environ, RENDER_START_METHOD=start_method)
+    output = subprocess.run([sys.executable, "main.py"], cwd=str(tmp_path), env=env, capture_output=True,
+                            text=True, check=True, timeout=120).stdout
+
+    for line in output.splitlines():
+        modules, main_file = json.loads(line)
+        assert "application" not in modules
+        # main.py wasn't run again as the worker's __main__
+        assert main_file is None
+    assert len(output.splitlines()) == 2
@@ -0,0 +1,84 @@
+import os
+import pytest
+import moto
+import s3client
+
+MIB = 1024 * 1024
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in (("AWS_ACCESS_KEY_ID", "testing"), ("AWS_SECRET_ACCESS_KEY", "testing"),
+                        ("AWS_SESSION_TOKEN", "testing"), ("AWS_DEFAULT_REGION", "us-east-1")):
+        monkeypatch.setenv(name, value)
+    # the smallest part s3 accepts, so a few MiB already go up in several parts
+    monkeypatch.setattr(s3client, "MULTIPART_CHUNKSIZE", 5 * MIB)
+    monkeypatch.setattr(s3client, "S3_ENDPOINT_URL", None)
+    with moto.mock_aws():
+        # a client made inside the mock, not one left by an earlier test
+        monkeypatch.setattr(s3client, "_pid", None)
+        client = s3client.get_client()
+        client.create_bucket(Bucket=s3client.BUCKET_NAME)
+        yield client
+
+
+def _stored(client, key):
+    return client.get_object(Bucket=s3client.BUCKET_NAME, Key=key)
+
+
+def test_large_pdf_is_uploaded_in_parts(s3):
+    data = os.urandom(12 * MIB)
+    assert s3client.upload_pdfs_to_aws({"cards.pdf": data}, "order-1") == ["cards.pdf"]
+
+    stored = _stored(s3, "order-1/cards.pdf")
+    assert stored["Body"].read() == data
+    # the etag of a multipart upload ends with its number of parts
+    assert stored["ETag"].strip('"').endswith("-3")
+
+
+def test_file_upload(s3, tmp_path):
+    path = tmp_path / "inserts.pdf"
+    path.write_bytes(b"%PDF-1.7 inserts")
+    assert s3client.upload_files_to_aws([str(path)], "order-1") == [str(path)]
+    assert _stored(s3, "order-1/inserts.pdf")["Body"].read() == b"%PDF-1.7 inserts"
+
+
+def test_empty_files_are_skipped(s3, tmp_path):
+    empty = tmp_path / "empty.pdf"
+    empty.write_bytes(b"")
+    assert s3client.upload_pdfs_to_aws({"inserts.pdf": b"", "cards.pdf": b"%PDF"}, "order-1") == ["cards.pdf"]
+    assert s3client.upload_files_to_aws([str(empty), str(tmp_path / "missing.pdf")], "order-1") == []
+
+    keys = [item["Key"] for item in s3.list_objects_v2(Bucket=s3client.BUCKET_NAME)["Contents"]]
+    assert keys == ["order-1/cards.pdf"]
+
+
+def test_failed_upload_is_reported(s3):
+    s3.delete_bucket(Bucket=s3client.BUCKET_NAME)
+    assert s3client.upload_pdfs_to_aws({"cards.pdf": b"%PDF"}, "order-1") == []
+
+
+def test_presigned_urls_are_signed_in_one_batch(s3):
+    s3client.upload_pdfs_to_aws({"inserts.pdf": b"inserts", "cards.pdf": b"cards"}, "order-1")
+
+    urls = s3client.generate_presigned_urls_for_keys(["order-1/inserts.pdf", "order-1/cards.pdf"])
+    assert set(urls) == {"order-1/inserts.pdf", "order-1/cards.pdf"}
+    for key, url in urls.items():
+        assert "/{}?".format(key) in url
+        assert "Signature=" in url or "X-Amz-Signature=" in url
+
+    inserts_url, cards_url = s3client.generate_presigned_urls("order-1")
+    assert inserts_url.split("?")[0].endswith("order-1/inserts.pdf")
+    assert cards_url.split("?")[0].endswith("order-1/cards.pdf")
+
+
+def test_signing_error_still_returns_a_pair(s3, monkeypatch):
+    from botocore.exceptions import ClientError
+
+    def fail(keys):
+        raise ClientError({"Error": {"Code": "AccessDenied", "Message": "denied"}}, "GetObject")
+
+    monkeypatch.setattr(s3client, "generate_presigned_urls_for_keys", fail)
+    # the callers unpack the result
+    inserts_url, cards_url = s3client.generate_presigned_urls("order-1")
+    assert inserts_url is None and cards_url is None
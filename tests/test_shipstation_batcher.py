@@ -0,0 +1,123 @@
+import time
+import pytest
+import http_clients
+from http_clients import ApiClient, TokenBucket
+from shipstation_batcher import ShipStationBatcher, ShipStationError
+from stub_server import StubServer
+
+
+def _order(key):
+    return {"orderKey": key, "orderNumber": key}
+
+
+def _created(body):
+    return 200, {}, {"results": [{"orderKey": order["orderKey"], "orderId": i, "success": True}
+                                 for i, order in enumerate(body)]}
+
+
+def _batcher(server, **kwargs):
+    return ShipStationBatcher(url=server.url + "/orders/createorders", client=ApiClient("stub", {}), **kwargs)
+
+
+def test_full_batch_is_sent_before_the_window_ends():
+    with StubServer(_created) as server:
+        batcher = _batcher(server, window=30, size=3)
+        started = time.monotonic()
+        futures = [batcher.submit(_order(str(i))) for i in range(3)]
+        results = [future.result(timeout=5) for future in futures]
+
+    assert time.monotonic() - started < 5
+    assert len(server.requests) == 1
+    assert [order["orderKey"] for order in server.requests[0]["body"]] == ["0", "1", "2"]
+    assert [result["orderKey"] for result in results] == ["0", "1", "2"]
+
+
+def test_orders_submitted_within_the_window_share_a_batch():
+    with StubServer(_created) as server:
+        batcher = _batcher(server, window=0.3, size=100)
+        started = time.monotonic()
+        futures = [batcher.submit(_order("a")), batcher.submit(_order("b"))]
+        for future in futures:
+            future.result(timeout=5)
+        elapsed = time.monotonic() - started
+        later = batcher.submit(_order("c"))
+        later.result(timeout=5)
+
+    assert elapsed >= 0.3
+    assert [[order["orderKey"] for order in request["body"]] for request in server.requests] == [["a", "b"], ["c"]]
+
+
+def test_batches_are_split_at_the_size():
+    with StubServer(_created) as server:
+        batcher = _batcher(server, window=0.2, size=2)
+        futures = [batcher.submit(_order(str(i))) for i in range(5)]
+        for future in futures:
+            future.result(timeout=5)
+
+    assert [len(request["body"]) for request in server.requests] == [2, 2, 1]
+
+
+def test_every_order_gets_its_own_result():
+    def answer(body):
+        return 200, {}, {"results": [
+            {"orderKey": "ok", "orderId": 7, "success": True},
+            {"orderKey": "bad", "success": False, "errorMessage": "invalid address"},
+        ]}
+
+    with StubServer(answer) as server:
+        batcher = _batcher(server, window=30, size=3)
+        ok, bad, missing = [batcher.submit(_order(key)) for key in ("ok", "bad", "missing")]
+
+        assert ok.result(timeout=5)["orderId"] == 7
+        with pytest.raises(ShipStationError, match="invalid address"):
+            bad.result(timeout=5)
+        with pytest.raises(ShipStationError, match="no result returned"):
+            missing.result(timeout=5)
+
+
+def test_failed_call_fails_every_order_of_the_batch(monkeypatch):
+    monkeypatch.setattr(http_clients, "MAX_RETRIES", 0)
+    with StubServer(lambda body: (400, {}, {"Message": "bad request"})) as server:
+        batcher = _batcher(server, window=30, size=2)
+        futures = [batcher.submit(_order(key)) for key in ("a", "b")]
+        for future in futures:
+            with pytest.raises(ShipStationError, match="400"):
+                future.result(timeout=5)
+
+
+def test_429_is_retried_after_retry_after(monkeypatch):
+    monkeypatch.setattr(http_clients, "backoff_delay", lambda attempt: 0)
+    answers = [(429, {"Retry-After": "1"}, {}), (200, {}, {"ok": True})]
+    limiter = TokenBucket(600)
+
+    with StubServer(lambda body: answers.pop(0)) as server:
+        client = ApiClient("stub", {}, limiter=limiter)
+        started = time.monotonic()
+        response = client.post(server.url + "/orders/createorders", data="[]")
+
+    assert response.status_code == 200
+    assert len(server.requests) == 2
+    assert time.monotonic() - started >= 1
+    # the limiter held every request back for the Retry-After delay
+    assert limiter.paused_until >= started + 1
+
+
+def test_token_bucket_blocks_once_empty():
+    bucket = TokenBucket(600)
+    for _ in range(600):
+        bucket.acquire()
+    started = time.monotonic()
+    bucket.acquire()
+    # 600 a minute refills a token every 0.1s
+    assert 0.05 <= time.monotonic() - started < 1
+
+
+def test_token_bucket_follows_the_rate_limit_headers():
+    bucket = TokenBucket(600)
+    bucket.update_from_headers({"X-Rate-Limit-Remaining": "2", "X-Rate-Limit-Reset": "30"})
+    assert bucket.tokens <= 2
+
+    bucket.update_from_headers({"X-Rate-Limit-Remaining": "0", "X-Rate-Limit-Reset": "0.3"})
+    started = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - started >= 0.25